@@ -0,0 +1,194 @@
+"""Compare record codecs on device and interface payloads shaped like
+NetBox 4 API responses.
+
+    python benchmarks/bench_codecs.py --records 20000
+
+Prints one JSON object per codec and payload type.
+"""
+import argparse
+import json
+import sys
+import time
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+URL = "https://netbox.example.com/api"
+
+
+def _brief(endpoint, oid, **fields):
+    ret = {
+        "id": oid,
+        "url": "%s/%s/%d/" % (URL, endpoint, oid),
+        "display": fields.get("name", str(oid)),
+    }
+    ret.update(fields)
+    return ret
+
+
+def device(i):
+    return {
+        "id": i,
+        "url": "%s/dcim/devices/%d/" % (URL, i),
+        "display": "sw-%05d" % i,
+        "name": "sw-%05d" % i,
+        "device_type": _brief(
+            "dcim/device-types",
+            i % 40,
+            manufacturer=_brief("dcim/manufacturers", 3, name="Vendor", slug="vendor"),
+            model="model-%d" % (i % 40),
+            slug="model-%d" % (i % 40),
+        ),
+        "role": _brief("dcim/device-roles", i % 5, name="access", slug="access"),
+        "tenant": None,
+        "platform": _brief("dcim/platforms", 2, name="os", slug="os"),
+        "serial": "SN%010d" % i,
+        "asset_tag": None,
+        "site": _brief("dcim/sites", i % 12, name="site-%d" % (i % 12), slug="s%d" % (i % 12)),
+        "location": None,
+        "rack": _brief("dcim/racks", i % 300, name="rack-%d" % (i % 300)),
+        "position": float(i % 42),
+        "face": {"value": "front", "label": "Front"},
+        "status": {"value": "active", "label": "Active"},
+        "airflow": None,
+        "primary_ip": None,
+        "primary_ip4": _brief("ipam/ip-addresses", i, family=4, address="10.0.%d.%d/24" % (i // 250 % 250, i % 250)),
+        "primary_ip6": None,
+        "oob_ip": None,
+        "cluster": None,
+        "virtual_chassis": None,
+        "vc_position": None,
+        "vc_priority": None,
+        "description": "",
+        "comments": "",
+        "config_template": None,
+        "local_context_data": None,
+        "tags": [_brief("extras/tags", 1, name="managed", slug="managed", color="9e9e9e")],
+        "custom_fields": {"poe_capable": bool(i % 2), "contract": None},
+        "created": "2024-03-01T10:22:33.123456Z",
+        "last_updated": "2024-05-07T08:01:02.654321Z",
+        "interface_count": 52,
+        "console_port_count": 1,
+        "power_port_count": 2,
+    }
+
+
+def interface(i):
+    dev = i // 48
+    return {
+        "id": i,
+        "url": "%s/dcim/interfaces/%d/" % (URL, i),
+        "display": "ge-0/0/%d" % (i % 48),
+        "device": _brief("dcim/devices", dev, name="sw-%05d" % dev),
+        "vdcs": [],
+        "module": None,
+        "name": "ge-0/0/%d" % (i % 48),
+        "label": "",
+        "type": {"value": "1000base-t", "label": "1000BASE-T (1GE)"},
+        "enabled": True,
+        "parent": None,
+        "bridge": None,
+        "lag": None if i % 8 else _brief("dcim/interfaces", i - i % 48, name="ae0"),
+        "mtu": 9216,
+        "mac_address": "00:11:22:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        "speed": None,
+        "duplex": None,
+        "wwn": None,
+        "mgmt_only": False,
+        "description": "uplink %d" % i if i % 48 == 47 else "",
+        "mode": {"value": "access", "label": "Access"},
+        "rf_role": None,
+        "rf_channel": None,
+        "poe_mode": None,
+        "poe_type": None,
+        "untagged_vlan": _brief("ipam/vlans", 100 + i % 20, vid=100 + i % 20, name="v%d" % (100 + i % 20)),
+        "tagged_vlans": [],
+        "mark_connected": False,
+        "cable": None if i % 3 else _brief("dcim/cables", i, label=""),
+        "cable_end": "A" if i % 3 == 0 else "",
+        "wireless_link": None,
+        "link_peers": [],
+        "link_peers_type": None,
+        "wireless_lans": [],
+        "vrf": None,
+        "l2vpn_termination": None,
+        "connected_endpoints": None,
+        "connected_endpoints_type": None,
+        "connected_endpoints_reachable": None,
+        "tags": [],
+        "custom_fields": {},
+        "created": "2024-03-01T10:22:33.123456Z",
+        "last_updated": "2024-05-07T08:01:02.654321Z",
+        "count_ipaddresses": 0,
+        "count_fhrp_groups": 0,
+        "_occupied": False,
+    }
+
+
+def codecs():
+    ret = {
+        "json": (
+            lambda v: json.dumps(v).encode("UTF-8"),
+            lambda b: json.loads(b.decode("UTF-8")),
+        )
+    }
+    if ujson is not None:
+        ret["ujson"] = (
+            lambda v: ujson.dumps(v).encode("UTF-8"),
+            lambda b: ujson.loads(b.decode("UTF-8")),
+        )
+    if msgpack is not None:
+        ret["msgpack"] = (
+            lambda v: msgpack.packb(v, use_bin_type=True),
+            lambda b: msgpack.unpackb(b, raw=False, strict_map_key=False),
+        )
+    return ret
+
+
+def run(records, rounds):
+    for kind, make in (("device", device), ("interface", interface)):
+        values = [{"ts": time.time(), "data": make(i)} for i in range(records)]
+        for name, (encode, decode) in codecs().items():
+            encoded = [encode(v) for v in values]
+            best_enc = best_dec = None
+            for _ in range(rounds):
+                start = time.perf_counter()
+                for v in values:
+                    encode(v)
+                enc = time.perf_counter() - start
+                start = time.perf_counter()
+                for b in encoded:
+                    decode(b)
+                dec = time.perf_counter() - start
+                best_enc = enc if best_enc is None else min(best_enc, enc)
+                best_dec = dec if best_dec is None else min(best_dec, dec)
+            yield {
+                "bench": "codec",
+                "payload": kind,
+                "codec": name,
+                "records": records,
+                "bytes_per_record": sum(len(b) for b in encoded) / records,
+                "encode_us": best_enc / records * 1e6,
+                "decode_us": best_dec / records * 1e6,
+            }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args(argv)
+    for result in run(args.records, args.rounds):
+        print(json.dumps(result))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Measure read throughput of a shared JsonDictCache by thread count.
+
+    python benchmarks/bench_threads.py --records 20000 --threads 1,2,4,8
+
+Fills a cache with device records, then lets every thread read random
+records through one readonly cache instance for --seconds. --locks global
+puts reads behind one exclusive lock, as before the reader-writer lock.
+Prints one JSON object per backend, lock and thread count.
+
+With a warm page cache reads are bound by decoding, which holds the GIL,
+so neither lock scales much on CPython. --latency adds a sleep to every
+database read to model a cold page cache or network storage, where
+overlapping reads is what the reader-writer lock buys.
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_codecs import device  # noqa: E402
+from cachedpynetbox.nbcache import pcache  # noqa: E402
+
+
+class GlobalLock(object):
+    # readers exclude each other too
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.lock:
+            yield
+
+    write = read
+
+
+class SlowHandle(object):
+    def __init__(self, db, latency):
+        super().__init__()
+        self.db = db
+        self.latency = latency
+
+    def get(self, key, default=None):
+        time.sleep(self.latency)
+        return self.db.get(key, default)
+
+    def get_many(self, keys):
+        time.sleep(self.latency)
+        return self.db.get_many(keys)
+
+    def __getattr__(self, attr):
+        return getattr(self.db, attr)
+
+
+def fill(path, backend, codec, records):
+    cache = pcache.JsonDictCache(
+        path, refresh=None, lifetime=7200, backend=backend, codec=codec
+    )
+    with cache.batch():
+        for i in range(0, records, 1000):
+            cache.set_many(
+                ("dcim.devices:%d" % oid, device(oid))
+                for oid in range(i, min(records, i + 1000))
+            )
+
+
+def measure(cache, threads, seconds, records, batch):
+    counts = [0] * threads
+    stop = threading.Event()
+    start = threading.Barrier(threads + 1)
+
+    def worker(n):
+        rnd = random.Random(n)
+        start.wait()
+        while not stop.is_set():
+            if batch > 1:
+                keys = [
+                    "dcim.devices:%d" % rnd.randrange(records) for _ in range(batch)
+                ]
+                cache.get_many(keys, memoize=False)
+            else:
+                cache.get_expiry("dcim.devices:%d" % rnd.randrange(records))
+            counts[n] += batch
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    start.wait()
+    began = time.perf_counter()
+    time.sleep(seconds)
+    stop.set()
+    for w in workers:
+        w.join()
+    return sum(counts) / (time.perf_counter() - began)
+
+
+def run(args):
+    for backend in args.backends:
+        tmp = tempfile.mkdtemp(prefix="cachedpynetbox-bench-")
+        try:
+            path = os.path.join(tmp, "cache")
+            fill(path, backend, args.codec, args.records)
+            for lock in args.locks:
+                cache = pcache.JsonDictCache(
+                    path,
+                    refresh=None,
+                    lifetime=7200,
+                    readonly=True,
+                    quick=True,
+                    backend=backend,
+                )
+                if lock == "global":
+                    cache.lock = GlobalLock()
+                if args.latency:
+                    cache.db = SlowHandle(cache.db, args.latency)
+                base = None
+                for threads in args.threads:
+                    reads = measure(
+                        cache, threads, args.seconds, args.records, args.batch
+                    )
+                    base = base or reads
+                    yield {
+                        "bench": "threaded_reads",
+                        "backend": backend,
+                        "codec": args.codec,
+                        "lock": lock,
+                        "threads": threads,
+                        "batch": args.batch,
+                        "latency": args.latency,
+                        "reads_per_second": reads,
+                        "speedup": reads / base,
+                    }
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument(
+        "--threads", type=lambda s: [int(n) for n in s.split(",")], default=[1, 2, 4, 8]
+    )
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument(
+        "--batch", type=int, default=1, help="records per get_many(), 1 uses get"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every read"
+    )
+    parser.add_argument(
+        "--backends", type=lambda s: s.split(","), default=["dbm", "sqlite"]
+    )
+    parser.add_argument("--locks", type=lambda s: s.split(","), default=["rw", "global"])
+    parser.add_argument("--codec", default="json", choices=["json", "msgpack"])
+    args = parser.parse_args(argv)
+    for result in run(args):
+        print(json.dumps(result))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
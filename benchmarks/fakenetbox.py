@@ -0,0 +1,382 @@
+"""A small stand-in for the NetBox REST API serving a synthetic dataset.
+
+    with FakeNetbox(Dataset(devices=1000)) as server:
+        nb = pynetbox(server.url + "api/", "token")
+
+Covers what cachedpynetbox uses: paginated lists with limit/offset, id,
+id__gt and time_after filters, exact match filters on top level fields,
+single objects, and POST/PATCH/DELETE, which are recorded in the
+core/object-changes changelog like NetBox does.
+"""
+import json
+import random
+import threading
+import time
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+OBJECT_TYPES = [
+    ("dcim", "device"),
+    ("dcim", "interface"),
+    ("dcim", "virtualchassis"),
+    ("dcim", "devicetype"),
+    ("dcim", "rack"),
+    ("ipam", "ipaddress"),
+    ("ipam", "prefix"),
+    ("ipam", "vlan"),
+    ("dcim", "cabletermination"),
+]
+
+ENDPOINTS = {
+    "dcim/devices": "dcim.device",
+    "dcim/interfaces": "dcim.interface",
+    "dcim/virtual-chassis": "dcim.virtualchassis",
+    "dcim/device-types": "dcim.devicetype",
+    "dcim/racks": "dcim.rack",
+    "ipam/ip-addresses": "ipam.ipaddress",
+    "ipam/prefixes": "ipam.prefix",
+    "ipam/vlans": "ipam.vlan",
+    "extras/object-types": "extras.objecttype",
+    "core/object-changes": "core.objectchange",
+}
+
+MAX_PAGE_SIZE = 1000
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class Dataset(object):
+    def __init__(
+        self,
+        devices=100,
+        interfaces_per_device=24,
+        ips_per_device=4,
+        prefixes=50,
+        vlans=50,
+        changes=0,
+        seed=1,
+    ):
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.base = ""
+        self.tables = dict((name, {}) for name in ENDPOINTS)
+        self._ids = dict((name, 0) for name in ENDPOINTS)
+
+        for app, model in OBJECT_TYPES:
+            self._add(
+                "extras/object-types",
+                {"app_label": app, "model": model, "display": "%s | %s" % (app, model)},
+            )
+        types = [
+            self._add(
+                "dcim/device-types",
+                {
+                    "model": "model-%d" % i,
+                    "slug": "model-%d" % i,
+                    "custom_fields": {"poe_capable": i % 2 == 0},
+                },
+            )
+            for i in range(10)
+        ]
+        racks = [self._add("dcim/racks", {"name": "rack-%d" % i}) for i in range(20)]
+        roles = ["leaf", "spine", "access", "core"]
+
+        for i in range(devices):
+            vc = None
+            if i % 10 < 2:
+                vcname = "vc-%d" % (i // 10)
+                vcs = [
+                    v for v in self.tables["dcim/virtual-chassis"].values()
+                    if v["name"] == vcname
+                ]
+                vc = vcs[0] if vcs else self._add(
+                    "dcim/virtual-chassis", {"name": vcname}
+                )
+            dtype = types[i % len(types)]
+            role = roles[i % len(roles)]
+            dev = self._add(
+                "dcim/devices",
+                {
+                    "name": "device-%d" % i,
+                    "serial": "SN%08d" % i if i % 3 else "",
+                    "role": {"id": roles.index(role) + 1, "slug": role, "name": role},
+                    "device_type": self._brief(dtype, "slug", "model"),
+                    "rack": self._brief(racks[i % len(racks)], "name"),
+                    "virtual_chassis": self._brief(vc, "name") if vc else None,
+                    "status": {"value": "active", "label": "Active"},
+                    "custom_fields": {},
+                },
+            )
+            lag = None
+            for j in range(interfaces_per_device):
+                if j == 0:
+                    itype = {"value": "lag", "label": "Link Aggregation Group (LAG)"}
+                else:
+                    itype = {"value": "1000base-t", "label": "1000BASE-T (1GE)"}
+                iface = self._add(
+                    "dcim/interfaces",
+                    {
+                        "name": "eth%d" % j,
+                        "device": self._brief(dev, "name"),
+                        "type": itype,
+                        "lag": self._brief(lag, "name") if lag and j < 3 else None,
+                        "enabled": True,
+                        "mtu": 1500,
+                        "description": "",
+                        "custom_fields": {},
+                    },
+                )
+                if j == 0:
+                    lag = iface
+                if j < ips_per_device:
+                    self._add(
+                        "ipam/ip-addresses",
+                        {
+                            "address": "10.%d.%d.%d/24" % (i // 250, i % 250, j + 1),
+                            "assigned_object_type": "dcim.interface",
+                            "assigned_object_id": iface["id"],
+                            "assigned_object": self._brief(iface, "name"),
+                            "status": {"value": "active", "label": "Active"},
+                        },
+                    )
+        for i in range(prefixes):
+            self._add("ipam/prefixes", {"prefix": "10.%d.0.0/16" % i})
+        for i in range(vlans):
+            self._add("ipam/vlans", {"vid": i + 1, "name": "vlan-%d" % (i + 1)})
+        self.mutate(changes)
+
+    def _add(self, endpoint, obj):
+        self._ids[endpoint] += 1
+        obj = dict(obj, id=self._ids[endpoint])
+        obj["url"] = "%s/api/%s/%d/" % (self.base, endpoint, obj["id"])
+        obj.setdefault("display", obj.get("name", str(obj["id"])))
+        self.tables[endpoint][obj["id"]] = obj
+        return obj
+
+    def _brief(self, obj, *fields):
+        brief = {"id": obj["id"], "url": obj["url"], "display": obj["display"]}
+        for field in fields:
+            brief[field] = obj[field]
+        return brief
+
+    def object_type(self, endpoint):
+        return ENDPOINTS[endpoint]
+
+    def record_change(self, endpoint, obj, action, prechange=None):
+        self._ids["core/object-changes"] += 1
+        csid = self._ids["core/object-changes"]
+        change = {
+            "id": csid,
+            "url": "%s/api/core/object-changes/%d/" % (self.base, csid),
+            "display": "%s %s" % (obj.get("display"), action),
+            "time": _now().isoformat(),
+            "action": {"value": action, "label": action.capitalize()},
+            "changed_object_type": self.object_type(endpoint),
+            "changed_object_id": obj["id"],
+            "prechange_data": prechange,
+            "postchange_data": None if action == "delete" else obj,
+        }
+        self.tables["core/object-changes"][csid] = change
+        return change
+
+    def mutate(self, count, endpoint="dcim/interfaces", skip_ids=0):
+        # skip_ids leaves holes in the changelog ids like rolled back
+        # transactions do on a real server
+        with self.lock:
+            table = self.tables[endpoint]
+            ids = list(table)
+            for _ in range(count):
+                obj = table[self.rand.choice(ids)]
+                pre = dict(obj)
+                obj["description"] = "changed %d" % self.rand.randint(0, 1 << 30)
+                self.record_change(endpoint, obj, "update", pre)
+                self._ids["core/object-changes"] += skip_ids
+
+    def create(self, endpoint, data):
+        with self.lock:
+            obj = self._add(endpoint, data)
+            self.record_change(endpoint, obj, "create")
+            return obj
+
+    def update(self, endpoint, oid, data):
+        with self.lock:
+            obj = self.tables[endpoint][oid]
+            pre = dict(obj)
+            obj.update(data)
+            self.record_change(endpoint, obj, "update", pre)
+            return obj
+
+    def delete(self, endpoint, oid):
+        with self.lock:
+            obj = self.tables[endpoint].pop(oid)
+            self.record_change(endpoint, obj, "delete", obj)
+
+    def query(self, endpoint, params):
+        with self.lock:
+            items = list(self.tables[endpoint].values())
+        if "id" in params:
+            wanted = set(int(i) for i in params["id"])
+            items = [i for i in items if i["id"] in wanted]
+        if "id__gt" in params:
+            gt = int(params["id__gt"][0])
+            items = [i for i in items if i["id"] > gt]
+        if "time_after" in params:
+            after = params["time_after"][0]
+            items = [i for i in items if i.get("time", "") > after]
+        for key, values in params.items():
+            if key in ("id", "id__gt", "time_after", "limit", "offset", "ordering", "brief"):
+                continue
+            items = [i for i in items if str(i.get(key)) in values]
+        reverse = params.get("ordering", ["id"])[0].startswith("-")
+        return sorted(items, key=lambda i: i["id"], reverse=reverse)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status, body=None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        data = json.dumps(body).encode("UTF-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("API-Version", "4.1")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts[:1] != ["api"]:
+            return None, None, None
+        parts = parts[1:]
+        oid = None
+        if parts and parts[-1].isdigit():
+            oid = int(parts.pop())
+        endpoint = "/".join(parts)
+        if endpoint not in ENDPOINTS:
+            return None, None, None
+        return endpoint, oid, parse_qs(url.query)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"null")
+
+    def do_GET(self):
+        self.server.stats["requests"] += 1
+        if self.path.rstrip("/") in ("/api", "/api/status"):
+            return self._send(200, {"netbox-version": "4.1.0"})
+        endpoint, oid, params = self._route()
+        if endpoint is None:
+            return self._send(404, {"detail": "Not found."})
+        data = self.server.dataset
+        if oid is not None:
+            obj = data.tables[endpoint].get(oid)
+            if obj is None:
+                return self._send(404, {"detail": "Not found."})
+            return self._send(200, obj)
+        items = data.query(endpoint, params)
+        limit = int(params.get("limit", [50])[0]) or MAX_PAGE_SIZE
+        limit = min(limit, MAX_PAGE_SIZE)
+        offset = int(params.get("offset", [0])[0])
+        page = items[offset : offset + limit]
+        nxt = None
+        if offset + limit < len(items):
+            query = dict((k, v) for k, v in params.items())
+            query["offset"] = [str(offset + limit)]
+            query["limit"] = [str(limit)]
+            nxt = "http://%s:%d/api/%s/?%s" % (
+                self.server.server_address[0],
+                self.server.server_address[1],
+                endpoint,
+                urlencode(query, doseq=True),
+            )
+        self._send(
+            200, {"count": len(items), "next": nxt, "previous": None, "results": page}
+        )
+
+    def do_POST(self):
+        self.server.stats["requests"] += 1
+        endpoint, oid, params = self._route()
+        if endpoint is None or oid is not None:
+            return self._send(404, {"detail": "Not found."})
+        body = self._body()
+        data = self.server.dataset
+        if isinstance(body, list):
+            return self._send(201, [data.create(endpoint, item) for item in body])
+        self._send(201, data.create(endpoint, body))
+
+    def do_PATCH(self):
+        self.server.stats["requests"] += 1
+        endpoint, oid, params = self._route()
+        if endpoint is None:
+            return self._send(404, {"detail": "Not found."})
+        body = self._body()
+        data = self.server.dataset
+        try:
+            if oid is None:
+                ret = [data.update(endpoint, item.pop("id"), item) for item in body]
+            else:
+                ret = data.update(endpoint, oid, body)
+        except KeyError:
+            return self._send(404, {"detail": "Not found."})
+        self._send(200, ret)
+
+    def do_DELETE(self):
+        self.server.stats["requests"] += 1
+        endpoint, oid, params = self._route()
+        if endpoint is None:
+            return self._send(404, {"detail": "Not found."})
+        try:
+            if oid is None:
+                for item in self._body():
+                    self.server.dataset.delete(endpoint, item["id"])
+            else:
+                self.server.dataset.delete(endpoint, oid)
+        except KeyError:
+            return self._send(404, {"detail": "Not found."})
+        self._send(204)
+
+
+class FakeNetbox(object):
+    def __init__(self, dataset, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__()
+        self.dataset = dataset
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.dataset = dataset
+        # seconds added to every response, like a remote NetBox
+        self.server.latency = latency
+        self.server.stats = {"requests": 0}
+        dataset.base = self.url.rstrip("/")
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server.server_address
+
+    @property
+    def requests(self):
+        return self.server.stats["requests"]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,224 @@
+"""Time cachedpynetbox against a local fake NetBox.
+
+    python benchmarks/run.py --devices 1000 --changes 500 --output results.jsonl
+
+Runs a cold sync and a changelog catch-up with a writer, the same cold
+sync with the asyncio client, then times getindex, all() and the pynetbox
+helpers with readers in quick, semi and non-quick mode. Prints one JSON
+object per measurement, times are the best of --rounds. --latency delays
+every response of the fake NetBox, like a remote one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cachedpynetbox import aio, pynetbox  # noqa: E402
+from fakenetbox import Dataset, FakeNetbox  # noqa: E402
+
+MODES = {"quick": True, "semi": "semi", "nonquick": False}
+
+
+def best(func, rounds):
+    ret = None
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        ret = func()
+        times.append(time.perf_counter() - start)
+    return min(times), ret
+
+
+class Bench(object):
+    def __init__(self, args):
+        super().__init__()
+        self.args = args
+        self.dataset = Dataset(
+            devices=args.devices,
+            interfaces_per_device=args.interfaces_per_device,
+            ips_per_device=args.ips_per_device,
+            prefixes=args.prefixes,
+            vlans=args.vlans,
+        )
+        self.tmp = tempfile.mkdtemp(prefix="cachedpynetbox-bench-")
+        self.dbpath = os.path.join(self.tmp, "cache")
+        self.server = None
+
+    def result(self, bench, seconds, **extra):
+        ret = {
+            "bench": bench,
+            "seconds": seconds,
+            "devices": self.args.devices,
+            "interfaces": len(self.dataset.tables["dcim/interfaces"]),
+            "backend": self.args.backend,
+            "codec": self.args.codec,
+        }
+        ret.update(extra)
+        return ret
+
+    def client(self, **kwargs):
+        return pynetbox(
+            self.server.url + "api/",
+            "token",
+            dbpath=self.dbpath,
+            backend=self.args.backend,
+            codec=self.args.codec,
+            **kwargs
+        )
+
+    def sync(self):
+        writer = self.client()
+        requests = self.server.requests
+
+        def cold():
+            writer.updater()
+            # racks() is not covered by updater()
+            writer.racks()
+
+        seconds, _ = best(cold, 1)
+        yield self.result(
+            "cold_sync", seconds, requests=self.server.requests - requests
+        )
+
+        # changes on a few types, the rest of the endpoints only have to
+        # notice that nothing concerns them
+        self.dataset.mutate(self.args.changes, endpoint="dcim/interfaces")
+        self.dataset.mutate(self.args.changes // 10 or 1, endpoint="dcim/devices")
+        requests = self.server.requests
+
+        def catchup():
+            writer._snb.follow()
+            writer.updater()
+            writer.racks()
+
+        seconds, _ = best(catchup, 1)
+        yield self.result(
+            "catchup",
+            seconds,
+            changes=self.args.changes + (self.args.changes // 10 or 1),
+            requests=self.server.requests - requests,
+        )
+
+    def async_sync(self):
+        async def cold():
+            async with aio.pynetbox(
+                self.server.url + "api/",
+                "token",
+                concurrency=self.args.concurrency,
+                dbpath=os.path.join(self.tmp, "async"),
+                backend=self.args.backend,
+                codec=self.args.codec,
+            ) as nb:
+                await nb.updater()
+                await nb.racks()
+
+        requests = self.server.requests
+        seconds, _ = best(lambda: asyncio.run(cold()), 1)
+        yield self.result(
+            "cold_sync_async",
+            seconds,
+            concurrency=self.args.concurrency,
+            requests=self.server.requests - requests,
+        )
+
+    def ops(self, nb):
+        devices = sorted(self.dataset.tables["dcim/devices"].values(), key=lambda d: d["id"])
+        sample = devices[:: max(1, len(devices) // self.args.lookups)][: self.args.lookups]
+        names = [d["name"] for d in sample]
+        serials = [d["serial"] for d in devices if d["serial"]][: self.args.lookups]
+        lags = [
+            i
+            for i in self.dataset.tables["dcim/interfaces"].values()
+            if i["type"]["value"] == "lag"
+        ][: self.args.lookups]
+        ifids = [i["id"] for i in lags]
+
+        return [
+            ("getindex.dev_by_name", len(names), lambda: [nb.dev_by_name(n) for n in names]),
+            ("getindex.dev_by_serial", len(serials), lambda: [nb.dev_by_serial(s) for s in serials]),
+            ("getindex.ip_by_int_id", len(ifids), lambda: [nb.ip_by_int_id(i) for i in ifids]),
+            ("all.devices", 1, nb.devices),
+            ("all.interfaces", 1, lambda: nb._snb.dcim.interfaces.all()),
+            ("helper.int_by_device_name", len(names), lambda: [nb.int_by_device_name(n) for n in names]),
+            ("helper.lag_members_by_iface", len(lags), lambda: [nb.lag_members_by_iface(i) for i in lags]),
+            ("helper.has_poe", len(sample), lambda: [nb.has_poe(d["device_type"]["model"]) for d in sample]),
+            ("helper.racks", 1, nb.racks),
+        ]
+
+    def readers(self):
+        for mode in self.args.modes:
+            nb = self.client(readonly=True, quick=MODES[mode])
+            for name, count, func in self.ops(nb):
+                requests = self.server.requests
+                seconds, _ = best(func, self.args.rounds)
+                yield self.result(
+                    name,
+                    seconds,
+                    mode=mode,
+                    ops=count,
+                    us_per_op=seconds / max(count, 1) * 1e6,
+                    requests=self.server.requests - requests,
+                )
+
+    def run(self):
+        with FakeNetbox(self.dataset, latency=self.args.latency) as self.server:
+            try:
+                for result in self.sync():
+                    yield result
+                for result in self.async_sync():
+                    yield result
+                for result in self.readers():
+                    yield result
+            finally:
+                shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--interfaces-per-device", type=int, default=24)
+    parser.add_argument("--ips-per-device", type=int, default=4)
+    parser.add_argument("--prefixes", type=int, default=50)
+    parser.add_argument("--vlans", type=int, default=50)
+    parser.add_argument("--changes", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds per fake NetBox response"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="requests in flight, asyncio client"
+    )
+    parser.add_argument("--backend", default="dbm", choices=["dbm", "sqlite"])
+    parser.add_argument("--codec", default="json", choices=["json", "msgpack"])
+    parser.add_argument(
+        "--modes",
+        type=lambda s: s.split(","),
+        default=list(MODES),
+        help="comma separated reader modes (%s)" % ",".join(MODES),
+    )
+    parser.add_argument("--output", help="append results here instead of stdout")
+    args = parser.parse_args(argv)
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error("unknown mode %r" % mode)
+
+    out = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for result in Bench(args).run():
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+
+import requests
+
+from .pynetbox import pynetbox as _pynetbox
+from .pynetbox import warm_targets
+
+logger = logging.getLogger("cachedpynetbox.aio")
+
+
+class AsyncSyncedNetbox(object):
+    # Drives a SyncedNetbox from asyncio. Endpoints sync concurrently, a
+    # full fetch requests the pages after the first one concurrently, and
+    # so does the changelog catch-up; at most concurrency requests are in
+    # flight. Cache work runs on a thread pool of the same size.
+    #
+    #   asnb = AsyncSyncedNetbox(SyncedNetbox(url, token, "cache.db"))
+    #   await asnb.warm(["dcim.devices", "dcim.interfaces"])
+    #   devices = await asnb.dcim.devices.getindex("name", "sw1")
+    PAGE_SIZE = 1000
+
+    class Accessor(object):
+        def __init__(self, asnb, path=[]):
+            super().__init__()
+            self._asnb = asnb
+            self._path = path
+
+        @property
+        def path(self):
+            return ".".join(self._path)
+
+        async def _run(self, method, *args, **kwargs):
+            sd = await self._asnb.sync(self.path)
+            return await self._asnb._call(getattr(sd, method), *args, **kwargs)
+
+        async def get(self, oid):
+            return await self._run("__getitem__", oid)
+
+        async def all(self):
+            return await self._run("all")
+
+        async def getindex(self, index, value):
+            return await self._run("getindex", index, value)
+
+        async def filter(self, **predicates):
+            return await self._run("filter", **predicates)
+
+        async def ensure_index(self, *fields):
+            return await self._run("ensure_index", *fields)
+
+        def __getattr__(self, attr):
+            return AsyncSyncedNetbox.Accessor(self._asnb, self._path + [attr])
+
+        def __repr__(self):
+            return "<AsyncSyncedNetbox.Accessor %r>" % (self._path)
+
+    def __init__(self, snb, concurrency=8, page_size=None):
+        self.snb = snb
+        self.concurrency = concurrency
+        self.page_size = page_size or self.PAGE_SIZE
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._loop = None
+        self._sem = None
+        self._locks = {}
+
+    def _limits(self):
+        # semaphores and locks belong to the loop they were made in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._sem = asyncio.Semaphore(self.concurrency)
+            self._locks = {}
+        return self._sem
+
+    async def _call(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool, functools.partial(func, *args, **kwargs)
+        )
+
+    async def _request(self, func, *args, **kwargs):
+        # takes one of the concurrency slots while func talks to NetBox
+        async with self._limits():
+            return await self._call(func, *args, **kwargs)
+
+    def _get(self, path, params):
+        # dcim.ip_addresses -> <url>/api/dcim/ip-addresses/
+        url = "%s/api/%s/" % (
+            self.snb._url.rstrip("/"),
+            path.replace(".", "/").replace("_", "-"),
+        )
+        r = self.snb._session.get(url, params=params)
+        r.raise_for_status()
+        return r.json()
+
+    async def fetch_all(self, path, **filters):
+        # every record of an endpoint matching filters, in id order
+        params = dict(filters, ordering="id", limit=self.page_size, offset=0)
+        first = await self._request(self._get, path, params)
+        step = len(first["results"])
+        pages = []
+        if step:
+            pages = await asyncio.gather(
+                *[
+                    self._request(self._get, path, dict(params, offset=offset))
+                    for offset in range(step, first["count"], step)
+                ]
+            )
+        records = {}
+        for page in [first] + list(pages):
+            for record in page["results"]:
+                records[record["id"]] = record
+        return [records[oid] for oid in sorted(records)]
+
+    async def follow(self):
+        # like SyncedNetbox.follow(), with the changelog pages fetched
+        # concurrently
+        snb = self.snb
+        if snb._readonly:
+            return await self._call(snb.changes_lastid)
+        last = await self._call(snb._cache.get_expiry, "changes:last")
+        if not last:
+            return await self._request(snb.follow)
+        with snb.metrics.timer("changelog_poll_seconds"):
+            snb._changes_error = None
+            try:
+                csets = await self.fetch_all("core.object_changes", id__gt=last)
+            except requests.RequestException as e:
+                logger.warning("changelog fetch after %r failed: %s" % (last, e))
+                snb._poll_failed(e)
+                csets = []
+            cursor = (last, None)
+            if csets:
+                cursor = await self._call(snb._ingest_changes, last, cursor, csets)
+            csid = snb._changes_cursor(cursor)
+        await self._call(snb._cache.__setitem__, "changes:last", csid)
+        if snb._changes_error is None:
+            snb._changes_ts = time.time()
+        return csid
+
+    async def sync(self, path):
+        # bring one endpoint up to date, returns its SyncedDict
+        sd = self.snb.endpoint(path)._make()
+        self._limits()
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            if sd._csid is None and await self._call(sd.needs_sync):
+                csid = await self._call(self.snb.changes_lastid)
+                logger.debug(
+                    "%s fetching all, %d pages at a time" % (path, self.concurrency)
+                )
+                records = await self.fetch_all(path)
+                await self._call(sd._update, False, (csid, records))
+            else:
+                await self._request(sd._update)
+        return sd
+
+    async def _ensure_indexes(self, path, fields):
+        sd = await self.sync(path)
+        async with self._locks[path]:
+            for field in fields:
+                await self._call(sd.ensure_index, *field.split("+"))
+
+    async def warm(self, endpoints=(), indexes=()):
+        # SyncedNetbox.warm(), with every endpoint syncing at once
+        with self.snb.untracked():
+            await self.follow()
+            await asyncio.gather(*[self.sync(path) for path in endpoints])
+            fields = {}
+            for path, field in indexes:
+                fields.setdefault(path, []).append(field)
+            await asyncio.gather(
+                *[self._ensure_indexes(path, f) for path, f in fields.items()]
+            )
+
+    async def related(self, name, *parent_ids):
+        await self.sync(self.snb.relation_index(name)[0])
+        return await self._call(self.snb.related, name, *parent_ids)
+
+    def endpoint(self, path):
+        return self.Accessor(self, path.split("."))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, attr):
+        return self.Accessor(self, [attr])
+
+
+class pynetbox(object):
+    # The pynetbox wrapper with awaitable methods, updater() hydrates all
+    # endpoints concurrently:
+    #
+    #   async with aio.pynetbox(url, token, dbpath="cache") as nb:
+    #       await nb.updater()
+    #       devices = await nb.dev_by_name("sw1")
+    def __init__(self, base_uri, token, concurrency=8, **kwargs):
+        self._nb = _pynetbox(base_uri, token, **kwargs)
+        self._snb = AsyncSyncedNetbox(self._nb._snb, concurrency)
+
+    async def updater(self):
+        await self._snb.warm(*warm_targets(self._nb._snb))
+
+    def close(self):
+        self._snb.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, attr):
+        func = getattr(self._nb, attr)
+        if attr.startswith("_") or not callable(func):
+            raise AttributeError(attr)
+
+        @functools.wraps(func)
+        async def call(*args, **kwargs):
+            return await self._snb._call(func, *args, **kwargs)
+
+        return call
@@ -0,0 +1,222 @@
+import dbm
+import dbm.gnu
+import os
+import sqlite3
+import urllib.parse
+from . import mmapstore
+
+
+class Backend(object):
+    # open() returns a handle with get(), get_many(), set(), delete(),
+    # keys(), sync() and close(); keys are str and values bytes
+    FILES = ("",)
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def open(self, readonly=False, sync=False):
+        raise NotImplementedError()
+
+    def compact(self, db):
+        # give the space of deleted keys back, db is open for writing
+        pass
+
+    def size(self):
+        ret = 0
+        for suffix in self.FILES:
+            try:
+                ret += os.path.getsize(self.path + suffix)
+            except OSError:
+                pass
+        return ret
+
+    def snapshot(self, db, dest):
+        # copy everything visible through the open handle db to a new
+        # database at dest
+        with type(self)(dest).open() as target:
+            keys = db.keys()
+            for i in range(0, len(keys), 1000):
+                for key, value in db.get_many(keys[i : i + 1000]).items():
+                    # mmap values are memoryviews
+                    target.set(key, bytes(value))
+            target.sync()
+
+
+class DbmHandle(object):
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    def get(self, key, default=None):
+        return self.db.get(key, default)
+
+    def get_many(self, keys):
+        ret = {}
+        for key in keys:
+            value = self.db.get(key)
+            if value is not None:
+                ret[key] = value
+        return ret
+
+    def set(self, key, value, ts=None):
+        self.db[key] = value
+
+    def delete(self, key):
+        del self.db[key]
+
+    def keys(self):
+        return [key.decode("UTF-8") for key in self.db.keys()]
+
+    def sync(self):
+        self.db.sync()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DbmBackend(Backend):
+    def open(self, readonly=False, sync=False):
+        if readonly:
+            flag = "ru"
+        elif sync:
+            flag = "cs"
+        else:
+            flag = "c"
+        return DbmHandle(dbm.gnu.open(self.path, flag))
+
+    def compact(self, db):
+        db.db.reorganize()
+
+
+class SqliteHandle(object):
+    # sqlite limits the number of bound parameters per statement
+    MAX_PARAMS = 500
+
+    def __init__(self, conn, autocommit):
+        super().__init__()
+        self.conn = conn
+        self.autocommit = autocommit
+
+    def get(self, key, default=None):
+        row = self.conn.execute(
+            "SELECT data FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else row[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        ret = {}
+        for i in range(0, len(keys), self.MAX_PARAMS):
+            chunk = keys[i : i + self.MAX_PARAMS]
+            rows = self.conn.execute(
+                "SELECT key, data FROM cache WHERE key IN (%s)"
+                % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            ret.update(rows)
+        return ret
+
+    def set(self, key, value, ts=None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, ts, data) VALUES (?, ?, ?)",
+            (key, ts, value),
+        )
+        if self.autocommit:
+            self.conn.commit()
+
+    def delete(self, key):
+        cur = self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        if self.autocommit:
+            self.conn.commit()
+        if cur.rowcount == 0:
+            raise KeyError(key)
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute("SELECT key FROM cache")]
+
+    def sync(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SqliteBackend(Backend):
+    # WAL mode lets any number of readers continue while the updater
+    # writes, the record timestamp is kept in its own column
+    FILES = ("", "-wal")
+
+    def open(self, readonly=False, sync=False):
+        if readonly:
+            conn = sqlite3.connect(
+                "file:%s?mode=ro" % urllib.parse.quote(self.path),
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, ts REAL, data BLOB) WITHOUT ROWID"
+            )
+            conn.commit()
+        return SqliteHandle(conn, autocommit=sync)
+
+    def compact(self, db):
+        db.conn.commit()
+        db.conn.execute("VACUUM")
+        db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def snapshot(self, db, dest):
+        if not isinstance(db, SqliteHandle):
+            return super().snapshot(db, dest)
+        db.conn.commit()
+        target = sqlite3.connect(dest)
+        db.conn.backup(target)
+        # a published snapshot is only read, and must not share -wal/-shm
+        # files with the snapshot it replaces
+        target.execute("PRAGMA journal_mode=DELETE")
+        target.close()
+
+
+class MmapBackend(Backend):
+    # readonly snapshots published by a writer, see mmapstore
+    def open(self, readonly=False, sync=False):
+        if not readonly:
+            raise IOError("mmap snapshots can only be opened readonly")
+        return mmapstore.MmapHandle(self.path)
+
+    def snapshot(self, db, dest):
+        mmapstore.write(dest, db)
+
+
+BACKENDS = {
+    "dbm": DbmBackend,
+    "sqlite": SqliteBackend,
+    "mmap": MmapBackend,
+}
+
+
+def get_backend(backend, path):
+    if isinstance(backend, Backend):
+        return backend
+    try:
+        return BACKENDS[backend](path)
+    except KeyError:
+        raise ValueError("unknown cache backend %r" % (backend,))
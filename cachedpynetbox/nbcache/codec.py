@@ -0,0 +1,69 @@
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec(object):
+    name = "json"
+    errors = (UnicodeDecodeError, ValueError)
+
+    def encode(self, value):
+        return json.dumps(value).encode("UTF-8")
+
+    def decode(self, raw):
+        # raw may be a memoryview, see mmapstore
+        return json.loads(str(raw, "UTF-8"))
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    def __init__(self):
+        super().__init__()
+        if msgpack is None:
+            raise ImportError("the msgpack codec requires the msgpack package")
+        self.errors = (ValueError, TypeError, msgpack.UnpackException)
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+}
+
+# Databases without a header are version 1, plain JSON records written
+# before the header existed. The header itself is always JSON. Version 3
+# keeps allids as a delta on a separate base and posting lists as id
+# sets, version 2 readers would misread both; version 2 data still reads.
+FORMAT_KEY = "__format__"
+FORMAT_VERSION = 3
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError("unknown cache codec %r" % (name,))
+
+
+def encode_header(codec):
+    return json.dumps({"version": FORMAT_VERSION, "codec": codec.name}).encode(
+        "UTF-8"
+    )
+
+
+def decode_header(raw):
+    if raw is None:
+        return None
+    return json.loads(str(raw, "UTF-8"))
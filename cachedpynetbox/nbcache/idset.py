@@ -0,0 +1,207 @@
+import array
+import base64
+import bisect
+import itertools
+import operator
+import zlib
+
+# Sets of object ids are stored as plain JSON lists while they are small,
+# larger ones as the zlib compressed deltas of the sorted ids. Dense id
+# ranges compress to a few bytes per thousand ids.
+PLAIN_MAX = 32
+
+
+class IdSet(object):
+    # a set of ints kept as a sorted array, iterates in ascending order
+    __slots__ = ("ids",)
+
+    def __init__(self, ids=()):
+        super().__init__()
+        self.ids = array.array("q", sorted(set(ids)))
+
+    @classmethod
+    def _sorted(cls, ids):
+        ret = cls.__new__(cls)
+        ret.ids = ids
+        return ret
+
+    def copy(self):
+        return self._sorted(array.array("q", self.ids))
+
+    def __contains__(self, oid):
+        i = bisect.bisect_left(self.ids, oid)
+        return i < len(self.ids) and self.ids[i] == oid
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet):
+            return self.ids == other.ids
+        return NotImplemented
+
+    def __repr__(self):
+        return "IdSet(%r)" % self.ids.tolist()
+
+    def add(self, oid):
+        i = bisect.bisect_left(self.ids, oid)
+        if i == len(self.ids) or self.ids[i] != oid:
+            self.ids.insert(i, oid)
+
+    def discard(self, oid):
+        i = bisect.bisect_left(self.ids, oid)
+        if i < len(self.ids) and self.ids[i] == oid:
+            del self.ids[i]
+
+    def update(self, oids):
+        for oid in oids:
+            self.add(oid)
+
+    def difference_update(self, oids):
+        for oid in oids:
+            self.discard(oid)
+
+    def __and__(self, other):
+        # probe the larger set for every id of the smaller one
+        small, large = (self, other) if len(self) <= len(other) else (other, self)
+        return self._sorted(array.array("q", (i for i in small if i in large)))
+
+    def intersection(self, *others):
+        ret = self
+        for other in sorted(others, key=len):
+            if not ret:
+                break
+            ret = ret & other
+        return ret
+
+    def __or__(self, other):
+        return self.union(self, other)
+
+    @classmethod
+    def union(cls, *sets):
+        if len(sets) == 1:
+            return sets[0]
+        return cls(itertools.chain.from_iterable(sets))
+
+    def encode(self):
+        if len(self.ids) <= PLAIN_MAX:
+            return self.ids.tolist()
+        deltas = array.array("q", [self.ids[0]])
+        deltas.extend(map(operator.sub, self.ids[1:], self.ids))
+        return {
+            "n": len(self.ids),
+            "z": base64.b64encode(zlib.compress(deltas.tobytes())).decode("ascii"),
+        }
+
+
+def decode(value):
+    if value is None:
+        return IdSet()
+    if isinstance(value, dict):
+        deltas = array.array("q")
+        deltas.frombytes(zlib.decompress(base64.b64decode(value["z"])))
+        return IdSet._sorted(array.array("q", itertools.accumulate(deltas)))
+    return IdSet(value)
+
+
+def encode(ids):
+    if not isinstance(ids, IdSet):
+        ids = IdSet(ids)
+    return ids.encode()
+
+
+class DeltaIdSet(object):
+    # The ids of an endpoint as a base, stored once under gen, plus the
+    # ids added and removed since. Changestates only carry the delta, the
+    # base is rewritten when the delta grows past REBASE_FRACTION of it.
+    REBASE_MIN = 256
+    REBASE_FRACTION = 0.05
+
+    def __init__(self, base, gen=None, added=(), removed=()):
+        super().__init__()
+        self.base = base
+        self.gen = gen
+        self.added = set(added)
+        self.removed = set(removed)
+        self.ids = base.copy()
+        self.ids.update(self.added)
+        self.ids.difference_update(self.removed)
+
+    def __contains__(self, oid):
+        return oid in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __and__(self, other):
+        return self.ids & other
+
+    def add(self, oid):
+        if oid in self.ids:
+            return
+        self.ids.add(oid)
+        if oid in self.removed:
+            self.removed.discard(oid)
+        else:
+            self.added.add(oid)
+
+    def discard(self, oid):
+        if oid not in self.ids:
+            return
+        self.ids.discard(oid)
+        if oid in self.added:
+            self.added.discard(oid)
+        else:
+            self.removed.add(oid)
+
+    def needs_rebase(self):
+        if self.gen is None:
+            return True
+        changed = len(self.added) + len(self.removed)
+        return changed > max(self.REBASE_MIN, len(self.ids) * self.REBASE_FRACTION)
+
+    def rebase(self, gen):
+        self.base = self.ids.copy()
+        self.gen = gen
+        self.added = set()
+        self.removed = set()
+
+    def delta(self):
+        return {
+            "base": self.gen,
+            "add": sorted(self.added),
+            "del": sorted(self.removed),
+        }
+
+
+class Postings(object):
+    # the posting lists of an index, decoded on first use and encoded
+    # back into the stored form by encoded()
+    def __init__(self, items):
+        super().__init__()
+        self.raw = items
+        self.decoded = {}
+
+    def __getitem__(self, key):
+        ids = self.decoded.get(key)
+        if ids is None:
+            ids = self.decoded[key] = decode(self.raw.get(key))
+        return ids
+
+    def keys(self):
+        return set(self.raw).union(self.decoded)
+
+    def encoded(self):
+        for key, ids in self.decoded.items():
+            if ids:
+                self.raw[key] = ids.encode()
+            else:
+                self.raw.pop(key, None)
+        self.decoded = {}
+        return self.raw
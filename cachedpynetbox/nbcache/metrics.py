@@ -0,0 +1,181 @@
+import bisect
+import contextlib
+import threading
+import time
+
+
+class Metrics(object):
+    # counters and latency histograms keyed by name and label values,
+    # collectors are called to refresh gauges before they are read
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+    def __init__(self, prefix="cachedpynetbox"):
+        super().__init__()
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {
+                    "buckets": [0] * (len(self.BUCKETS) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            hist["buckets"][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            hist["count"] += 1
+            hist["sum"] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    def snapshot(self):
+        self.collect()
+
+        def entry(key, value):
+            return dict(name=key[0], labels=dict(key[1]), value=value)
+
+        with self.lock:
+            return {
+                "counters": [entry(k, v) for k, v in sorted(self.counters.items())],
+                "gauges": [entry(k, v) for k, v in sorted(self.gauges.items())],
+                "histograms": [
+                    entry(
+                        k,
+                        dict(
+                            buckets=dict(zip(self.BUCKETS + ("+Inf",), _cumulative(v))),
+                            count=v["count"],
+                            sum=v["sum"],
+                        ),
+                    )
+                    for k, v in sorted(self.histograms.items())
+                ],
+            }
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        self.collect()
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name, items in _by_name(values):
+                    name = "%s_%s" % (self.prefix, name)
+                    if kind == "counter":
+                        name += "_total"
+                    lines.append("# TYPE %s %s" % (name, kind))
+                    for labels, value in items:
+                        lines.append("%s%s %s" % (name, _labels(labels), _num(value)))
+            for name, items in _by_name(self.histograms):
+                name = "%s_%s" % (self.prefix, name)
+                lines.append("# TYPE %s histogram" % name)
+                for labels, hist in items:
+                    for le, count in zip(self.BUCKETS + ("+Inf",), _cumulative(hist)):
+                        lines.append(
+                            "%s_bucket%s %d"
+                            % (name, _labels(labels + (("le", str(le)),)), count)
+                        )
+                    lines.append("%s_sum%s %s" % (name, _labels(labels), _num(hist["sum"])))
+                    lines.append("%s_count%s %d" % (name, _labels(labels), hist["count"]))
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics(object):
+    # stands in when metrics are disabled, every call is a no-op
+    _timer = contextlib.nullcontext()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self._timer
+
+    def add_collector(self, collector):
+        pass
+
+    def collect(self):
+        pass
+
+    def snapshot(self):
+        return {"counters": [], "gauges": [], "histograms": []}
+
+    def prometheus(self):
+        return ""
+
+    def __bool__(self):
+        return False
+
+
+def get_metrics(metrics):
+    if isinstance(metrics, (Metrics, NullMetrics)):
+        return metrics
+    return Metrics() if metrics else NullMetrics()
+
+
+def _cumulative(hist):
+    total = 0
+    ret = []
+    for count in hist["buckets"]:
+        total += count
+        ret.append(total)
+    return ret
+
+
+def _by_name(values):
+    ret = {}
+    for (name, labels), value in sorted(values.items()):
+        ret.setdefault(name, []).append((labels, value))
+    return sorted(ret.items())
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+
+
+def _num(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value))
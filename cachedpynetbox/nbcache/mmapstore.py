@@ -0,0 +1,116 @@
+import mmap
+import struct
+
+# Read-only snapshot format meant to be mapped by many processes at once:
+#
+#   header   magic, number of keys, offset of the key table
+#   data     key and value bytes as they were copied
+#   table    one entry per key, sorted by key: key offset/length and
+#            value offset/length into the data section
+#
+# Lookups binary search the table in the mapping, so nothing is loaded
+# up front and the pages are shared through the OS page cache. Values
+# are returned as memoryviews into the mapping, the codecs decode them
+# without a copy; only the short keys probed are copied, memoryviews
+# can't be ordered.
+MAGIC = b"CPNBMAP1"
+HEADER = struct.Struct("<8sQQ")
+ENTRY = struct.Struct("<QIQI")
+
+
+class MmapHandle(object):
+    def __init__(self, path):
+        super().__init__()
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        magic, self.count, self.table = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise IOError("%s is not a cache snapshot" % path)
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self.mm, self.table + i * ENTRY.size)
+
+    def _key(self, entry):
+        return self.view[entry[0] : entry[0] + entry[1]]
+
+    def _find(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            found = self._key(entry)
+            if found == key:
+                return entry
+            if found.tobytes() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get(self, key, default=None):
+        entry = self._find(key.encode("UTF-8"))
+        if entry is None:
+            return default
+        return self.view[entry[2] : entry[2] + entry[3]]
+
+    def get_many(self, keys):
+        ret = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                ret[key] = value
+        return ret
+
+    def set(self, key, value, ts=None):
+        raise IOError("cache snapshots are readonly")
+
+    def delete(self, key):
+        raise IOError("cache snapshots are readonly")
+
+    def keys(self):
+        return [
+            str(self._key(self._entry(i)), "UTF-8") for i in range(self.count)
+        ]
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mm.close()
+        except BufferError:
+            # values still in use keep the mapping until they are gone
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write(path, db):
+    # copy everything visible through the open handle db to path
+    keys = sorted(key.encode("UTF-8") for key in db.keys())
+    entries = []
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        offset = HEADER.size
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i : i + 1000]
+            values = db.get_many([key.decode("UTF-8") for key in chunk])
+            for key in chunk:
+                value = values.get(key.decode("UTF-8"))
+                if value is None:
+                    continue
+                f.write(key)
+                f.write(value)
+                entries.append((offset, len(key), offset + len(key), len(value)))
+                offset += len(key) + len(value)
+        for entry in entries:
+            f.write(ENTRY.pack(*entry))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(entries), offset))
@@ -1,26 +1,108 @@
 import time
+import os
+import gzip
+import atexit
+import contextlib
+import fcntl
+import threading
+import weakref
 import requests
 from . import pcache
+from . import metrics as nbmetrics
+from . import idset
+from . import webhook
 import pynetbox
 from pprint import pprint, pformat
 import logging
 from typing import Any
 import datetime
+import concurrent.futures
+import json
 
 logger = logging.getLogger("syncednetbox")
 
+# instances tracking usage, their last usage is saved at exit
+_tracking = weakref.WeakSet()
+
+
+@atexit.register
+def _save_usage():
+    for snb in list(_tracking):
+        try:
+            snb.save_usage()
+        except Exception:
+            logger.exception("saving usage profile at exit failed")
+
+
+def _last_updated(record):
+    # a record's last_updated as a datetime, None if it has none; NetBox
+    # writes UTC with a Z, which fromisoformat() only takes from 3.11 on
+    value = record.get("last_updated") if isinstance(record, dict) else None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+
 
 class SyncedNetbox(object):
     OBJECTCHANGE_ACTION_CREATE = "create"
     OBJECTCHANGE_ACTION_UPDATE = "update"
     OBJECTCHANGE_ACTION_DELETE = "delete"
 
+    CHANGES_PAGE_SIZE = 500
+    CHANGES_GAP_GRACE = 30.0
+    # how long changes:last is trusted before a read polls the changelog
+    CHANGES_EXPIRY = 15.0
+    INDEX_UPDATE_LIMIT = 500
+    FETCH_CHUNK_SIZE = 100
+    FETCH_WORKERS = 4
+    FANOUT_BUCKET = 1000
+    CHANGES_RETAIN = 10000
+    SNAPSHOT_FORMAT = "cachedpynetbox-snapshot"
+    SNAPSHOT_VERSION = 1
+    # what consumers use is saved this often, entries unused for
+    # USAGE_MAX_AGE drop out of the profile; USAGE_KEY holds what
+    # writers saved in the cache before they used the usage file too
+    USAGE_KEY = "usage:profile"
+    USAGE_FLUSH_INTERVAL = 60.0
+    USAGE_MAX_AGE = 7 * 86400
+
+    # Parent -> children joins: name -> (child endpoint, field referencing
+    # the parent id, fixed conditions on the child). Each is an index on
+    # the child endpoint, patched from the changelog like any other index.
+    RELATIONS = {
+        "virtual_chassis.devices": ("dcim.devices", "virtual_chassis.id", {}),
+        "device.interfaces": ("dcim.interfaces", "device.id", {}),
+        "lag.members": ("dcim.interfaces", "lag.id", {}),
+        "interface.ip_addresses": (
+            "ipam.ip_addresses",
+            "assigned_object.id",
+            {"assigned_object_type": "dcim.interface"},
+        ),
+    }
+
+    # Endpoint -> the changed_object_type (app_label.model) NetBox logs
+    # its changes under, where object_type() can't derive it from the
+    # endpoint name
+    OBJECT_TYPES = {
+        "dcim.virtual_chassis": "dcim.virtualchassis",
+        "virtualization.interfaces": "virtualization.vminterface",
+    }
+
     class SyncedDict(object):
         def __init__(self, snb, path):
             super().__init__()
             self._snb = snb
             self._path = path
             self._csid = None
+            self._synced = None
+            self._indexes = set()
+            # (gen, IdSet) of the last allids base we read or wrote
+            self._allids_base = None
+            # serializes syncs, webhook write-through and index rebuilds
+            # on background threads, which all change _allids and write
+            # the changestate
+            self._lock = threading.RLock()
 
         @property
         def netboxdata(self):
@@ -29,16 +111,52 @@ class SyncedNetbox(object):
                 netboxdata = getattr(netboxdata, item)
             return netboxdata
 
-        def _update(self, force=False):
+        def _state(self, force=False):
+            # the stored changestate and its ids, None ids mean a full sync
+            path = ".".join(self._path) + ":"
+            changestate = self._snb._cache.get_expiry(path)
+            if changestate is not None:
+                self._indexes.update(changestate.get("indexes", []))
+
+            allids = None
+            if changestate is not None and not force:
+                if changestate["csid"] + 1 < self._snb.changes_firstid():
+                    # compacted away changes we have not seen, resync
+                    logger.debug("%s fell behind the changelog" % path)
+                else:
+                    allids = self._load_allids(changestate)
+            return changestate, allids
+
+        def needs_sync(self):
+            # whether _update() has to fetch the whole endpoint
+            return not self._snb._readonly and self._state()[1] is None
+
+        def _update(self, force=False, prefetched=None):
+            # prefetched is (csid, records) of a full fetch started after
+            # changes_lastid() returned csid, used if a full sync is due
             if self._csid == self._snb.changes_lastid() and not force:
                 return
+            with self._lock:
+                # another thread may have caught up while we waited
+                if self._csid == self._snb.changes_lastid() and not force:
+                    return
+                self._sync(force, prefetched)
 
+        def _sync(self, force, prefetched):
             path = ".".join(self._path) + ":"
-            changestate = self._snb._cache.get_expiry(path)
+            changestate, allids = self._state(force)
 
             if self._snb._readonly:
+                if allids is None:
+                    # the updater stored a new base between our reads
+                    changestate = self._snb._cache.get_expiry(path)
+                    allids = self._load_allids(changestate)
+                    if allids is None:
+                        raise IOError("%s: allids base missing" % path)
+                if self._snb._cache.mem is not None:
+                    self._invalidate(changestate)
                 self._csid = changestate["csid"]
-                self._allids = set(changestate["allids"])
+                self._allids = allids
                 return
 
                 # logger.debug('%s no data, special-case fetch...' % path)
@@ -49,152 +167,495 @@ class SyncedNetbox(object):
                 # assert resp.status_code == 200
                 allitems = list(resp)
 
-                self._allids = set([item["id"] for item in allitems])
-                for item in allitems:
-                    ipath = "%s:%d" % (".".join(self._path), int(item["id"]))
-                    self._snb._cache[ipath] = dict(item)
-
-            elif changestate is None or force:
-                logger.debug("%s no data/force, fetching all..." % path)
+                self._allids = idset.DeltaIdSet(
+                    idset.IdSet(item["id"] for item in allitems)
+                )
+                self._synced = time.time()
+                writes = [
+                    ("%s:%d" % (".".join(self._path), int(item["id"])), dict(item))
+                    for item in allitems
+                ]
+                drops = []
 
-                csid = self._snb.changes_lastid()
-                allitems = list(self.netboxdata.all())
-                self._allids = set([item.id for item in allitems])
-                for item in allitems:
-                    ipath = "%s:%d" % (".".join(self._path), int(item.id))
-                    self._snb._cache[ipath] = dict(item)
+            elif allids is None:
+                if prefetched is not None:
+                    csid, allitems = prefetched
+                else:
+                    logger.debug("%s no data/force, fetching all..." % path)
+                    csid = self._snb.changes_lastid()
+                    allitems = [dict(item) for item in self.netboxdata.all()]
+                self._allids = idset.DeltaIdSet(
+                    idset.IdSet(item["id"] for item in allitems)
+                )
+                self._synced = time.time()
+                writes = [
+                    ("%s:%d" % (".".join(self._path), int(item["id"])), item)
+                    for item in allitems
+                ]
+                drops = []
             else:
                 csid = changestate["csid"]
-                self._allids = set(changestate["allids"])
+                self._allids = allids
+                self._synced = changestate.get("synced")
+                writes = []
+                drops = []
 
-                changes = list(self._snb.changes_since(csid))
+                head = self._snb.changes_lastid()
+                changes = self._changes(csid, head)
                 if len(changes) > 0:
                     logger.debug(
-                        "%s changeset %r -> %r"
-                        % (".".join(self._path), csid, changes[-1]["id"])
+                        "%s changeset %r -> %r" % (".".join(self._path), csid, head)
                     )
-                for change in changes:
-                    csid = change["id"]
-                    objtype = change["changed_object_type"]
-
-                    if objtype == "dcim.cabletermination" and (
-                        path.startswith("dcim.") or path.startswith("circuits")
-                    ):
-                        action = change["action"]["value"]
-                        if action == self._snb.OBJECTCHANGE_ACTION_DELETE:
-                            change_data = change["prechange_data"]
-                            action = self._snb.OBJECTCHANGE_ACTION_UPDATE
-                        else:
-                            change_data = change["postchange_data"]
-                        ct_dict = self._snb._cache[
-                                "extras.object_types:%d"
-                            % (change_data["termination_type"])
-                        ]
-                        termination_id_name = (
-                            ct_dict["app_label"] + "." + ct_dict["model"]
-                        )
-
-                        if ".".join(self._path).startswith(termination_id_name):
-                            # We also must update the termination endpoint
-                            oid = change_data["termination_id"]
-                            logger.debug(
-                                "termination endpoint updating %s:%d"
-                                % (termination_id_name, oid)
-                            )
-                        else:
-                            continue
-
-                        logger.debug("Parsing %s", change["display"])
-
-                    elif ".".join(self._path) not in [objtype, objtype + "s"]:
-                        continue
-                    else:
-                        oid = change["changed_object_id"]
-                        action = change["action"]["value"]
-
-                    if action == self._snb.OBJECTCHANGE_ACTION_DELETE:
-                        logger.debug(
-                            "cset %r for %s delete %r"
-                            % (change["id"], ".".join(self._path), oid)
-                        )
-                        try:
-                            self._allids.remove(oid)
-                        except KeyError:
-                            pass
-                    else:
-                        logger.debug(
-                            "cset %r for %s update %r"
-                            % (change["id"], ".".join(self._path), oid)
-                        )
-                        self._allids.add(oid)
-                        ipath = "%s:%d" % (".".join(self._path), oid)
-                        try:
-                            del self._snb._cache[ipath]
-                        except KeyError:
-                            pass
-
-            changestate = {"csid": csid, "allids": list(self._allids)}
+                touched = {}
+                for change_id, oid, action in changes:
+                    logger.debug(
+                        "cset %r for %s %s %r"
+                        % (change_id, ".".join(self._path), action, oid)
+                    )
+                    touched.pop(oid, None)
+                    touched[oid] = action
+                csid = max(csid, head)
+                if touched or csid != changestate["csid"]:
+                    # indexes current before stay current, even if none of
+                    # the changes were to this endpoint
+                    writes, drops = self._apply(touched, changestate["csid"], csid)
+
+            self._store(csid, writes, drops)
+
+        def _store(self, csid, writes, drops):
+            path = ".".join(self._path) + ":"
+            if self._allids.needs_rebase():
+                gen = max(int(time.time() * 1000), (self._allids.gen or 0) + 1)
+                self._allids.rebase(gen)
+                self._allids_base = (gen, self._allids.base)
+                writes.append(
+                    (path + "allids", {"gen": gen, "ids": self._allids.base.encode()})
+                )
+            changestate = {
+                "csid": csid,
+                "allids": self._allids.delta(),
+                "synced": self._synced,
+                "indexes": sorted(self._indexes),
+            }
+            writes.append((path, changestate))
+            with self._snb._cache.batch() as cache:
+                cache.delete_many(drops)
+                cache.set_many(writes)
             self._csid = csid
-            self._snb._cache[path] = changestate
+
+        def _load_allids(self, changestate):
+            # the ids as of changestate, or None if its base is gone; the
+            # base is only read again when its generation changed
+            allids = changestate["allids"]
+            if isinstance(allids, list):
+                # stored before delta updates
+                return idset.DeltaIdSet(idset.IdSet(allids))
+            gen = allids["base"]
+            if self._allids_base is None or self._allids_base[0] != gen:
+                key = ".".join(self._path) + ":allids"
+                base = self._snb._cache.get_expiry(key)
+                if base is not None and base["gen"] != gen:
+                    # the updater may have rebased since we memoized it
+                    self._snb._cache.invalidate(key)
+                    base = self._snb._cache.get_expiry(key)
+                if base is None or base["gen"] != gen:
+                    return None
+                self._allids_base = (gen, idset.decode(base["ids"]))
+            return idset.DeltaIdSet(
+                self._allids_base[1], gen, allids["add"], allids["del"]
+            )
+
+        def apply(self, records, delete=False):
+            # write-through of records the server returned for our own
+            # writes, the changelog brings the same changes again later
+            with self._lock:
+                self._apply_records(records, delete)
+
+        def _apply_records(self, records, delete):
+            self._update()
+            records = self._not_older(records)
+            if not records:
+                return
+            touched = {}
+            fetched = {}
+            for record in records:
+                oid = int(record["id"])
+                if delete:
+                    touched[oid] = self._snb.OBJECTCHANGE_ACTION_DELETE
+                    continue
+                if oid in self._allids:
+                    touched[oid] = self._snb.OBJECTCHANGE_ACTION_UPDATE
+                else:
+                    touched[oid] = self._snb.OBJECTCHANGE_ACTION_CREATE
+                fetched[oid] = record
+            writes, drops = self._apply(touched, self._csid, self._csid, fetched)
+            if len(touched) > self._snb.INDEX_UPDATE_LIMIT:
+                # not patched, and the csid does not move on to mark them
+                # outdated
+                basepath = ".".join(self._path)
+                drops.extend("%s:by-%s" % (basepath, f) for f in self._indexes)
+            self._store(self._csid, writes, drops)
+
+        def _not_older(self, records):
+            # a late or retried webhook must not undo a change the
+            # changelog already brought, records older than the cached
+            # ones are skipped, deletes too
+            basepath = ".".join(self._path)
+            keys = ["%s:%d" % (basepath, int(record["id"])) for record in records]
+            stored = self._snb._cache.get_many(
+                [key for key, record in zip(keys, records) if _last_updated(record)]
+            )
+            ret = []
+            for key, record in zip(keys, records):
+                new = _last_updated(record)
+                old = _last_updated(stored.get(key, {}).get("data"))
+                if new is not None and old is not None and new < old:
+                    logger.debug("%s: skipping record older than the cached one", key)
+                    continue
+                ret.append(record)
+            return ret
+
+        def _apply(self, touched, fromcsid, tocsid, fetched=None):
+            # returns the records to write and the stale ones to drop,
+            # fetched has the new records if the caller already has them
+            basepath = ".".join(self._path)
+            cache = self._snb._cache
+            writes = []
+            drops = []
+
+            # indexes which were current before these changes are patched,
+            # anything else (or a too large burst) is rebuilt on next use
+            indexes = {}
+            if len(touched) <= self._snb.INDEX_UPDATE_LIMIT:
+                for field in self._indexes:
+                    idx = cache.get_expiry("%s:by-%s" % (basepath, field))
+                    if idx is not None and idx["cset"] == fromcsid:
+                        indexes[field] = idx
+
+            postings = dict(
+                (field, idset.Postings(idx["items"])) for field, idx in indexes.items()
+            )
+            if fetched is None and indexes and touched:
+                fetched = self.fetch(
+                    [
+                        oid
+                        for oid, action in touched.items()
+                        if action != self._snb.OBJECTCHANGE_ACTION_DELETE
+                    ]
+                )
+
+            for oid, action in touched.items():
+                ipath = "%s:%d" % (basepath, oid)
+                if action == self._snb.OBJECTCHANGE_ACTION_DELETE:
+                    self._allids.discard(oid)
+                else:
+                    self._allids.add(oid)
+                old = None
+                if indexes and action != self._snb.OBJECTCHANGE_ACTION_CREATE:
+                    old = cache.get_expiry(ipath)
+                new = fetched.get(oid) if fetched else None
+                if new is not None:
+                    writes.append((ipath, new))
+                elif action != self._snb.OBJECTCHANGE_ACTION_DELETE:
+                    drops.append(ipath)
+                for field in indexes:
+                    if old is not None:
+                        oldkeys = self._indexkeys(old, field)
+                    elif action == self._snb.OBJECTCHANGE_ACTION_CREATE:
+                        oldkeys = []
+                    else:
+                        # unknown, every posting list has to be checked
+                        oldkeys = postings[field].keys()
+                    self._reindex(postings[field], field, oid, oldkeys, new)
+
+            for field, idx in indexes.items():
+                logger.debug(
+                    "index %s attr %s patched %r -> %r"
+                    % (basepath, field, fromcsid, tocsid)
+                )
+                if touched:
+                    self._snb.metrics.inc(
+                        "index_patches", endpoint=basepath, field=field
+                    )
+                idx["cset"] = tocsid
+                idx["items"] = postings[field].encoded()
+                writes.append(("%s:by-%s" % (basepath, field), idx))
+            return writes, drops
+
+        def _indexkeys(self, item, field):
+            if "+" in field:
+                return [
+                    json.dumps([self._indexkeys(item, f)[0] for f in field.split("+")])
+                ]
+            val = item
+            for i in field.split("."):
+                if val is None or i not in val or val[i] is None:
+                    return ["NONE"]
+                val = val[i]
+            return ["VAL:%s" % val, "ANY"]
+
+        def _reindex(self, postings, field, oid, oldkeys, new):
+            for key in oldkeys:
+                postings[key].discard(oid)
+            if new is not None:
+                for key in self._indexkeys(new, field):
+                    postings[key].add(oid)
+
+        def _touched(self, change):
+            path = ".".join(self._path) + ":"
+            objtype = change["changed_object_type"]
+
+            if objtype == "dcim.cabletermination" and (
+                path.startswith("dcim.") or path.startswith("circuits")
+            ):
+                action = change["action"]["value"]
+                if action == self._snb.OBJECTCHANGE_ACTION_DELETE:
+                    change_data = change["prechange_data"]
+                    action = self._snb.OBJECTCHANGE_ACTION_UPDATE
+                else:
+                    change_data = change["postchange_data"]
+                ct_dict = self._snb._cache[
+                        "extras.object_types:%d"
+                    % (change_data["termination_type"])
+                ]
+                termination_id_name = (
+                    ct_dict["app_label"] + "." + ct_dict["model"]
+                )
+
+                if self._snb.object_type(".".join(self._path)) == termination_id_name:
+                    # We also must update the termination endpoint
+                    oid = change_data["termination_id"]
+                    logger.debug(
+                        "termination endpoint updating %s:%d"
+                        % (termination_id_name, oid)
+                    )
+                else:
+                    return None
+
+                logger.debug("Parsing %s", change["display"])
+                return action, oid
+
+            elif self._snb.object_type(".".join(self._path)) != objtype:
+                return None
+            return change["action"]["value"], change["changed_object_id"]
+
+        def _changes(self, csid, head):
+            # (change id, oid, action) for this endpoint after csid, from
+            # the per-type fan-out when it covers the range
+            types = [self._snb.object_type(".".join(self._path))]
+            changes = self._snb.changes_for(types, csid, head)
+            if changes is not None:
+                return changes
+            changes = []
+            for change in self._snb.changes_since(csid, head):
+                touched = self._touched(change)
+                if touched is not None:
+                    changes.append((change["id"], touched[1], touched[0]))
+            return changes
+
+        def _invalidate(self, changestate):
+            # drop memoized records the updater process has changed since
+            # our last look, a full resync replaces everything
+            basepath = ".".join(self._path)
+            if (
+                self._csid is None
+                or changestate.get("synced") != self._synced
+                or self._csid + 1 < self._snb.changes_firstid()
+            ):
+                self._snb._cache.invalidate_prefix(basepath + ":")
+            else:
+                for _, oid, _ in self._changes(self._csid, changestate["csid"]):
+                    self._snb._cache.invalidate("%s:%d" % (basepath, oid))
+            self._synced = changestate.get("synced")
 
         def __getitem__(self, item):
             self._update()
+            self._snb._used("endpoints", ".".join(self._path))
             path = "%s:%d" % (".".join(self._path), int(item))
             return self._snb._cache[path]
 
-        def getindex(self, index, value):
-            self._update()
-
+        def _index(self, field):
             basepath = ".".join(self._path)
-            path = "%s:by-%s" % (basepath, index)
-            idx = self._snb._cache[path]
-            if idx["cset"] != self._snb.changes_lastid():
-                if self._snb._readonly:
+            self._snb._used("indexes", "%s:%s" % (basepath, field))
+            path = "%s:by-%s" % (basepath, field)
+            cache = self._snb._cache
+            idx = cache.get_expiry(path)
+            if self._snb._readonly:
+                if idx["cset"] != self._csid:
+                    # the updater may have rebuilt it since we memoized it
+                    cache.invalidate(path)
+                    idx = cache.get_expiry(path)
+                if idx["cset"] != self._csid:
                     logger.error(
                         "index %s attr %s outdated index at %s (current %s)"
-                        % (basepath, index, idx["cset"], self._snb.changes_lastid())
+                        % (basepath, field, idx["cset"], self._csid)
                     )
-                else:
-                    del self._snb._cache[path]
-                    idx = self._snb._cache[path]
+                return idx
+            if idx is None or idx["cset"] != self._csid:
+                # rebuilt and stored under the lock, so apply() on another
+                # thread comes either before the rebuild or patches it
+                with self._lock:
+                    idx = cache.get_expiry(path)
+                    if idx is None or idx["cset"] != self._csid:
+                        idx = self.refresh("by-" + field)
+                        cache[path] = idx
+            return idx
+
+        def _qval(self, value):
             if value is None:
-                qval = "NONE"
+                return "NONE"
             elif value is Any:
-                qval = "ANY"
-            else:
-                qval = "VAL:%s" % value
-            results = [
-                self._snb._cache["%s:%d" % (basepath, k)]
-                for k in idx["items"].get(qval, [])
-            ]
+                return "ANY"
+            return "VAL:%s" % value
+
+        def _load(self, ids):
+            basepath = ".".join(self._path)
+            return [self._snb._cache["%s:%d" % (basepath, k)] for k in ids]
+
+        def getindex(self, index, value):
+            self._update()
+
+            basepath = ".".join(self._path)
+            self._snb._used("endpoints", basepath)
+            idx = self._index(index)
+            results = self._load(idset.decode(idx["items"].get(self._qval(value))))
             logger.debug(
                 f"index {basepath} attr {index} value {repr(value)} => {len(results)} results"
             )
             return sorted(results, key=lambda i: i["id"])
 
+        def ensure_index(self, *fields):
+            self._update()
+            self._index("+".join(fields))
+
+        def filter(self, **predicates):
+            # field__sub=value matches dotted field "field.sub", a trailing
+            # __in matches any of a list of values
+            self._update()
+            self._snb._used("endpoints", ".".join(self._path))
+
+            wanted = {}
+            for key, value in predicates.items():
+                if key.endswith("__in"):
+                    wanted[key[:-4].replace("__", ".")] = list(value)
+                else:
+                    wanted[key.replace("__", ".")] = [value]
+
+            postings = []
+            compounds = [i.split("+") for i in self._indexes if "+" in i]
+            for fields in sorted(compounds, key=len, reverse=True):
+                if all(
+                    len(wanted.get(f, [])) == 1 and wanted[f][0] is not Any
+                    for f in fields
+                ):
+                    key = json.dumps([self._qval(wanted.pop(f)[0]) for f in fields])
+                    postings.append(("+".join(fields), [key]))
+            for field, values in wanted.items():
+                postings.append((field, [self._qval(v) for v in values]))
+
+            ids = None
+            for field, keys in postings:
+                items = self._index(field)["items"]
+                matched = idset.IdSet.union(*[idset.decode(items.get(k)) for k in keys])
+                ids = matched if ids is None else ids & matched
+                if not ids:
+                    break
+            if ids is None:
+                ids = self._allids
+
+            results = self._load(sorted(ids))
+            logger.debug(
+                "filter %s %r => %d results"
+                % (".".join(self._path), predicates, len(results))
+            )
+            return results
+
         def all(self):
             self._update()
             basepath = ".".join(self._path)
+            self._snb._used("endpoints", basepath)
             return self._snb._cache.get_batch(basepath, self._allids)
 
+        def iterall(self, fields=None, chunksize=1000):
+            # like all(), but records are read and decoded chunksize at a
+            # time and not kept in the memo; fields projects each record
+            # to the given (dotted) fields
+            self._update()
+            basepath = ".".join(self._path)
+            self._snb._used("endpoints", basepath)
+            ids = sorted(self._allids)
+            for i in range(0, len(ids), chunksize):
+                chunk = self._snb._cache.get_batch(
+                    basepath, ids[i : i + chunksize], memoize=False, total=len(ids)
+                )
+                for item in chunk:
+                    if item is None:
+                        continue
+                    if fields is not None:
+                        item = self._project(item, fields)
+                    yield item
+
+        @staticmethod
+        def _project(item, fields):
+            # nested like the record, so item["device"]["name"] still works
+            ret = {}
+            for field in fields:
+                val = item
+                src = ret
+                parts = field.split(".")
+                for i in parts[:-1]:
+                    val = val.get(i) if isinstance(val, dict) else None
+                    if val is None:
+                        src[i] = None
+                        break
+                    if not isinstance(src.get(i), dict):
+                        src[i] = {}
+                    src = src[i]
+                else:
+                    src[parts[-1]] = (
+                        val.get(parts[-1]) if isinstance(val, dict) else None
+                    )
+            return ret
+
+        def fetch(self, oids):
+            # chunked id filters instead of one GET per object, the chunks
+            # run on FETCH_WORKERS threads
+            oids = sorted(oids)
+            size = self._snb.FETCH_CHUNK_SIZE
+            chunks = [oids[i : i + size] for i in range(0, len(oids), size)]
+
+            def fetch_chunk(chunk):
+                return [dict(item) for item in self.netboxdata.filter(id=chunk)]
+
+            if len(chunks) > 1 and self._snb.FETCH_WORKERS > 1:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._snb.FETCH_WORKERS
+                ) as pool:
+                    results = list(pool.map(fetch_chunk, chunks))
+            else:
+                results = [fetch_chunk(chunk) for chunk in chunks]
+            return dict((item["id"], item) for result in results for item in result)
+
         def refresh(self, oid):
             assert oid != ""
             if oid.startswith("by-"):
-                idxfield = oid[3:].split(".")
-                index = {
-                    "cset": self._snb.changes_lastid(),
-                    "items": {},
-                }
-                for item in self.all():
-                    val = item
-                    for i in idxfield:
-                        if val is None or i not in val or val[i] is None:
-                            index["items"].setdefault("NONE", []).append(item["id"])
-                            break
-                        val = val[i]
-                    else:
-                        index["items"].setdefault("VAL:%s" % val, []).append(item["id"])
-                        index["items"].setdefault("ANY", []).append(item["id"])
+                field = oid[3:]
+                basepath = ".".join(self._path)
+                self._snb.metrics.inc("index_rebuilds", endpoint=basepath, field=field)
+                with self._lock, self._snb.metrics.timer(
+                    "index_rebuild_seconds", endpoint=basepath
+                ):
+                    items = self.all()
+                    index = {
+                        "cset": self._csid,
+                        "items": {},
+                    }
+                    for item in items:
+                        for key in self._indexkeys(item, field):
+                            index["items"].setdefault(key, []).append(item["id"])
+                    for key, ids in index["items"].items():
+                        index["items"][key] = idset.encode(ids)
+                self._indexes.add(field)
                 return index
 
             path = ".".join(self._path) + ":"
@@ -224,9 +685,18 @@ class SyncedNetbox(object):
         def all(self):
             return self._make().all()
 
+        def iterall(self, fields=None, chunksize=1000):
+            return self._make().iterall(fields, chunksize)
+
         def getindex(self, index, value):
             return self._make().getindex(index, value)
 
+        def filter(self, **predicates):
+            return self._make().filter(**predicates)
+
+        def ensure_index(self, *fields):
+            return self._make().ensure_index(*fields)
+
         def __getitem__(self, item):
             return self._make()[item]
 
@@ -236,20 +706,66 @@ class SyncedNetbox(object):
         def __repr__(self):
             return "<SyncedNetbox.Accessor %r>" % (self._path)
 
-    def __init__(self, url, token, cachefile="cache.db", readonly=False, quick=False):
+    def __init__(
+        self,
+        url,
+        token,
+        cachefile="cache.db",
+        readonly=False,
+        quick=False,
+        memcache=0,
+        memcache_bytes=0,
+        backend="dbm",
+        codec="json",
+        metrics=False,
+        changes_expiry=None,
+        stale_while_revalidate=0,
+        refresh_workers=2,
+        track_usage=True,
+        migrate_codec=False,
+    ):
         self._dicts = {}
+        self.changes_expiry = changes_expiry or self.CHANGES_EXPIRY
+        # pass True or a Metrics instance to collect cache/sync metrics
+        self.metrics = nbmetrics.get_metrics(metrics)
+        self.metrics.add_collector(self._collect_metrics)
         self._cache = pcache.JsonDictCache(
             cachefile,
             refresh=self.refresh,
+            refresh_many=self.refresh_many,
             lifetime=7200,
             readonly=readonly,
             quick=quick,
+            memcache=memcache,
+            memcache_bytes=memcache_bytes,
+            backend=backend,
+            codec=codec,
+            metrics=self.metrics,
+            stale_while_revalidate=stale_while_revalidate,
+            refresh_workers=refresh_workers,
+            migrate_codec=migrate_codec,
         )
         self._url = url
         self._netbox = pynetbox.api(url=url, token=token, threading=True)
         self._changes = None
         self._changes_ts = None
+        # why the last changelog poll failed, None if it succeeded
+        self._changes_error = None
+        self._changes_gaps = {}
+        self._fanout_lock = threading.Lock()
+        self._relations = dict(self.RELATIONS)
+        self._relations_ready = set()
         self._readonly = readonly
+        # endpoints and indexes read since the last save_usage(), see
+        # usage_profile()
+        self._cachefile = cachefile
+        self._tracking = track_usage
+        self._usage = {"endpoints": {}, "indexes": {}}
+        self._usage_lock = threading.Lock()
+        self._usage_flushing = threading.Lock()
+        self._usage_saved = time.time()
+        if track_usage:
+            _tracking.add(self)
 
         self._session = requests.Session()
         if token != None:
@@ -275,38 +791,30 @@ class SyncedNetbox(object):
             lastchange = self._cache.get_expiry("changes:last")
             logger.debug(lastchange)
             if lastchange is not None and lastchange != 0:
-                csid = lastchange
-                head = lastchange
-                nxid = 0
-                while nxid < 4:
-                    head += 1
-                    try:
-                        cset = self._netbox.core.object_changes.get(head)
-                        if not cset:
-                            nxid += 1
-                            continue
-                    except pynetbox.core.query.RequestError:
-                        nxid += 1
-                        continue
-
-                    cset = dict(cset)
-                    csid = cset["id"]
-
-                    logger.debug("cset append %r" % csid)
-                    self._cache["changes:%d" % csid] = cset
-                    nxid = 0
+                with self.metrics.timer("changelog_poll_seconds"):
+                    csid = self._follow_changes(lastchange)
                 logger.debug("cset updated to %r" % csid)
             else:
                 logger.debug("cset initializing from scratch")
                 last_30 = datetime.datetime.utcnow() - datetime.timedelta(minutes=30)
-                csets = self._netbox.core.object_changes.filter(time_after=last_30)
-                csets = sorted(csets, key=lambda x: x.id)
+                try:
+                    csets = self._netbox.core.object_changes.filter(
+                        time_after=last_30
+                    )
+                    csets = sorted(
+                        [dict(cset) for cset in csets], key=lambda x: x["id"]
+                    )
+                except Exception as e:
+                    self._poll_failed(e)
+                    raise
                 csid = None
-                for cset in csets:
-                    cset = dict(cset)
-                    csid = cset["id"]
-                    self._cache["changes:%d" % csid] = cset
+                if csets:
+                    csid = csets[-1]["id"]
+                    self._store_changes(csets, csets[0]["id"])
                     logger.debug("cset initialized at %r" % csid)
+                self._changes_error = None
+            if self._changes_error is None:
+                self._changes_ts = time.time()
             return csid
 
         elif path == "changes":
@@ -318,17 +826,567 @@ class SyncedNetbox(object):
             p = getattr(p, pc)
         return p.refresh(oid)
 
-    def changes_lastid(self):
-        last_changes = self._cache.get_expiry("changes:last", expiry=15.0)
+    def refresh_many(self, path, oids):
+        return self.endpoint(path)._make().fetch(oids)
+
+    def _follow_changes(self, csid):
+        # Page through the changelog by id. Holes in the id sequence are
+        # normal (rolled back transactions), but a hole may also be a
+        # transaction that has not committed yet, so the returned cursor
+        # is held back before holes younger than CHANGES_GAP_GRACE.
+        cursor = (csid, None)
+        self._changes_error = None
+        while True:
+            try:
+                page = self._netbox.core.object_changes.filter(
+                    id__gt=cursor[0],
+                    ordering="id",
+                    limit=self.CHANGES_PAGE_SIZE,
+                    offset=0,
+                )
+                csets = [dict(cset) for cset in page]
+            except (
+                pynetbox.core.query.RequestError,
+                requests.RequestException,
+            ) as e:
+                logger.warning("changelog fetch after %r failed: %s" % (cursor[0], e))
+                self._poll_failed(e)
+                break
+            if not csets:
+                break
+            cursor = self._ingest_changes(csid, cursor, csets)
+            if len(csets) < self.CHANGES_PAGE_SIZE:
+                break
+        return self._changes_cursor(cursor)
+
+    def _poll_failed(self, error):
+        # the last successful poll and the lag stay as they were
+        self._changes_error = str(error)
+        self.metrics.inc("changelog_poll_errors")
+
+    def _ingest_changes(self, csid, cursor, csets):
+        # store csets, which follow cursor = (last id, held back id) in
+        # id order, returns the new cursor
+        now = time.time()
+        last, holdback = cursor
+        for cset in csets:
+            # every missing id is timed from when it was first seen, so
+            # holes found together expire together
+            young = False
+            for gap in range(last + 1, cset["id"]):
+                seen = self._changes_gaps.setdefault(gap, now)
+                young = young or now - seen < self.CHANGES_GAP_GRACE
+            if young and holdback is None:
+                logger.debug("cset gap after %r, holding back" % last)
+                holdback = last
+            last = cset["id"]
+        logger.debug("cset append %r..%r" % (csets[0]["id"], last))
+        self.metrics.inc("changelog_changes", len(csets))
+        self._store_changes(csets, csid + 1)
+        return last, holdback
+
+    def _changes_cursor(self, cursor):
+        last, holdback = cursor
+        if holdback is not None:
+            last = holdback
+        self._changes_gaps = dict(
+            (gap, seen) for gap, seen in self._changes_gaps.items() if gap > last
+        )
+        return last
+
+    def _fanout_entries(self, cset):
+        objtype = cset["changed_object_type"]
+        action = cset["action"]["value"]
+        yield objtype, cset["changed_object_id"], action
+
+        if objtype == "dcim.cabletermination":
+            # the termination endpoint changes along with the cable
+            if action == self.OBJECTCHANGE_ACTION_DELETE:
+                change_data = cset["prechange_data"]
+            else:
+                change_data = cset["postchange_data"]
+            ct_dict = self._cache[
+                "extras.object_types:%d" % change_data["termination_type"]
+            ]
+            yield (
+                ct_dict["app_label"] + "." + ct_dict["model"],
+                change_data["termination_id"],
+                self.OBJECTCHANGE_ACTION_UPDATE,
+            )
+
+    def _store_changes(self, csets, start):
+        # the fan-out buckets are read, merged and written back under one
+        # lock and batch, so followers don't drop each other's entries
+        with self._fanout_lock, self._cache.batch():
+            self._cache.set_many(
+                [("changes:%d" % c["id"], c) for c in csets]
+                + self._fanout(csets, start)
+            )
+
+    def _fanout(self, csets, start):
+        # Sort new changes into per object type buckets of FANOUT_BUCKET
+        # change ids, so an endpoint catching up reads its own changes
+        # instead of every changeset. Changes fetched again after a held
+        # back cursor are merged, not duplicated.
+        buckets = {}
+        for cset in csets:
+            bucket = cset["id"] // self.FANOUT_BUCKET
+            for objtype, oid, action in self._fanout_entries(cset):
+                buckets.setdefault(
+                    "changes:type:%s:%d" % (objtype, bucket), []
+                ).append([cset["id"], oid, action])
+
+        writes = []
+        stored = self._cache.get_many(list(buckets))
+        for key, entries in buckets.items():
+            merged = stored.get(key, {}).get("data", [])
+            known = set(entry[0] for entry in merged)
+            merged.extend(entry for entry in entries if entry[0] not in known)
+            merged.sort()
+            writes.append((key, merged))
+        if self._cache.get_expiry("changes:fanout") is None:
+            writes.append(("changes:fanout", start))
+        return writes
+
+    def publish(self, dest, backend=None):
+        self._cache.publish(dest, backend)
+
+    def endpoint(self, path):
+        return self.Accessor(self, path.split("."))
+
+    def object_type(self, path):
+        # ipam.ip_addresses -> ipam.ipaddress, dcim.device_types ->
+        # dcim.devicetype, the change log's name for the endpoint's model
+        if path in self.OBJECT_TYPES:
+            return self.OBJECT_TYPES[path]
+        app, _, name = path.rpartition(".")
+        name = name.replace("_", "")
+        if name.endswith("ies"):
+            name = name[:-3] + "y"
+        elif name.endswith(("sses", "xes")):
+            name = name[:-2]
+        elif name.endswith("s") and not name.endswith("ss"):
+            name = name[:-1]
+        # plugins.netbox_bgp.sessions -> netbox_bgp.session
+        return "%s.%s" % (app.rpartition(".")[2], name)
+
+    def add_relation(self, name, path, field, **conditions):
+        self._relations[name] = (path, field, conditions)
+        self._relations_ready.discard(name)
+
+    def relation_index(self, name):
+        # (endpoint, index field) to warm for a relation
+        path, field, conditions = self._relations[name]
+        return path, "+".join(sorted(conditions) + [field])
+
+    def write_through(self, path, records, delete=False):
+        # apply the server's answer to our own writes to the cached
+        # endpoint, endpoints nobody synced yet are left alone
+        if not records:
+            return
+        if self._readonly:
+            for record in records:
+                self._cache.invalidate("%s:%d" % (path, int(record["id"])))
+            return
+        if self._cache.get_expiry(path + ":") is None:
+            return
+        self.endpoint(path)._make().apply(records, delete)
+
+    def related(self, name, *parent_ids):
+        # the children of the given parents, sorted by id
+        path, field, conditions = self._relations[name]
+        endpoint = self.endpoint(path)
+        if conditions and name not in self._relations_ready:
+            endpoint.ensure_index(*self.relation_index(name)[1].split("+"))
+            self._relations_ready.add(name)
+        predicates = dict((k.replace(".", "__"), v) for k, v in conditions.items())
+        predicates[field.replace(".", "__") + "__in"] = parent_ids
+        return endpoint.filter(**predicates)
+
+    def listen_webhooks(
+        self, host="127.0.0.1", port=0, secret=None, poll_interval=None
+    ):
+        # start a webhook.WebhookReceiver, stop() it when done; pair
+        # poll_interval with a changes_expiry above it so reads never poll
+        return webhook.WebhookReceiver(self, host, port, secret, poll_interval).start()
+
+    def follow(self):
+        # poll the changelog now instead of when changes:last expires
+        csid = self.refresh("changes:last")
+        self._cache["changes:last"] = csid
+        return int(csid) if csid else 0
+
+    def warm(self, endpoints=(), indexes=()):
+        with self.untracked():
+            for path in endpoints:
+                self.endpoint(path)._make()._update()
+            for path, field in indexes:
+                self.endpoint(path).ensure_index(*field.split("+"))
+
+    @contextlib.contextmanager
+    def untracked(self):
+        # reads that keep the cache warm are not usage
+        tracking, self._tracking = self._tracking, False
+        try:
+            yield
+        finally:
+            self._tracking = tracking
+
+    def _used(self, kind, name):
+        if not self._tracking:
+            return
+        now = time.time()
+        with self._usage_lock:
+            entry = self._usage[kind].setdefault(name, [0, now])
+            entry[0] += 1
+            entry[1] = now
+            due = now - self._usage_saved >= self.USAGE_FLUSH_INTERVAL
+        if due and self._usage_flushing.acquire(blocking=False):
+            # saved on a thread of its own, reads never wait for it
+            threading.Thread(
+                target=self._flush_usage, name="cachedpynetbox-usage", daemon=True
+            ).start()
+
+    def _flush_usage(self):
+        try:
+            self.save_usage()
+        except Exception:
+            logger.exception("saving usage profile failed")
+        finally:
+            self._usage_flushing.release()
+
+    def _merge_usage(self, *profiles):
+        # {"endpoints": {path: [count, last used]}, "indexes":
+        # {"path:field": [count, last used]}}
+        ret = {"endpoints": {}, "indexes": {}}
+        horizon = time.time() - self.USAGE_MAX_AGE
+        for profile in profiles:
+            for kind, entries in ret.items():
+                for name, (count, last) in (profile or {}).get(kind, {}).items():
+                    if last < horizon:
+                        continue
+                    entry = entries.setdefault(name, [0, 0])
+                    entry[0] += count
+                    entry[1] = max(entry[1], last)
+        return ret
+
+    def _usage_file(self, cachefile):
+        # readonly consumers can't write the cache, their usage goes here
+        return cachefile + ".usage.json"
+
+    def _read_usage_file(self, cachefile):
+        try:
+            with open(self._usage_file(cachefile)) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return json.loads(f.read() or "null")
+        except (OSError, ValueError):
+            return None
+
+    def _write_usage_file(self, cachefile, usage):
+        with open(self._usage_file(cachefile), "a+") as f:
+            # BlockingIOError if another process is writing it
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            f.seek(0)
+            try:
+                profile = json.loads(f.read() or "null")
+            except ValueError:
+                profile = None
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(self._merge_usage(profile, usage)))
+
+    def save_usage(self):
+        # add what was used since the last call to the profile in a file
+        # next to the cache, which takes none of the cache's locks; if the
+        # file is busy the usage is kept for the next call
+        with self._usage_lock:
+            usage, self._usage = self._usage, {"endpoints": {}, "indexes": {}}
+            self._usage_saved = time.time()
+        if not usage["endpoints"] and not usage["indexes"]:
+            return
+        try:
+            self._write_usage_file(self._cachefile, usage)
+        except OSError as e:
+            logger.warning("saving usage profile failed: %s" % e)
+            with self._usage_lock:
+                self._usage = self._merge_usage(usage, self._usage)
+
+    def usage_profile(self, cachefiles=()):
+        # what consumers of this cache used in the last USAGE_MAX_AGE, and
+        # readonly consumers of the caches at cachefiles (e.g. where the
+        # updater publishes)
+        profiles = [self._cache.get_expiry(self.USAGE_KEY)]
+        seen = set()
+        for cachefile in [self._cachefile] + list(cachefiles):
+            if os.path.abspath(cachefile) not in seen:
+                seen.add(os.path.abspath(cachefile))
+                profiles.append(self._read_usage_file(cachefile))
+        with self._usage_lock:
+            return self._merge_usage(*profiles, self._usage)
+
+    def warm_targets(self, cachefiles=()):
+        # (endpoints, indexes) for warm() from usage_profile(), most used
+        # first; both empty if nothing was recorded yet
+        profile = self.usage_profile(cachefiles)
+
+        def byuse(entries):
+            return sorted(entries, key=lambda name: (-entries[name][0], name))
+
+        return (
+            byuse(profile["endpoints"]),
+            [tuple(name.split(":", 1)) for name in byuse(profile["indexes"])],
+        )
+
+    def status(self, poll=True):
+        csid = self.changes_lastid(poll)
+        last_change = self._cache.get_expiry("changes:%d" % csid) if csid else None
+        endpoints = {}
+        for path, sd in sorted(self._dicts.items()):
+            if sd._csid is not None:
+                endpoints[path] = {
+                    "csid": sd._csid,
+                    "behind": csid - sd._csid,
+                    "objects": len(sd._allids),
+                }
+        return {
+            "csid": csid,
+            "last_change_time": last_change["time"] if last_change else None,
+            "last_poll": self._changes_ts,
+            "lag_seconds": (
+                time.time() - self._changes_ts if self._changes_ts else None
+            ),
+            "poll_error": self._changes_error,
+            "endpoints": endpoints,
+        }
+
+    def _collect_metrics(self, metrics):
+        # a scrape reports what is stored, it doesn't poll NetBox
+        status = self.status(poll=False)
+        metrics.set("changelog_csid", status["csid"])
+        metrics.set("changelog_lag_seconds", status["lag_seconds"])
+        for path, endpoint in status["endpoints"].items():
+            metrics.set("endpoint_behind_csids", endpoint["behind"], endpoint=path)
+            metrics.set("endpoint_objects", endpoint["objects"], endpoint=path)
+
+    def updater_status(self):
+        # what the updater process last stored, see cachedpynetbox.updater
+        return self._cache.get_expiry("updater:status")
+
+    def changes_lastid(self, poll=True):
+        # without poll what is stored, even if it expired
+        last_changes = self._cache.get_expiry(
+            "changes:last", expiry=self.changes_expiry if poll else None
+        )
         return int(last_changes) if last_changes else 0
 
-    def changes_since(self, lastid):
-        head = self.changes_lastid()
+    def changes_since(self, lastid, head=None):
+        if head is None:
+            head = self.changes_lastid()
         for i in range(lastid + 1, head + 1):
             item = self._cache.get_expiry("changes:%d" % i)
             if item is not None:
                 yield item
 
+    def changes_for(self, types, lastid, head=None):
+        # (change id, oid, action) for the given object types, or None if
+        # the fan-out does not reach back to lastid
+        if head is None:
+            head = self.changes_lastid()
+        start = self._cache.get_expiry("changes:fanout")
+        if start is None or lastid + 1 < start:
+            return None
+        keys = [
+            "changes:type:%s:%d" % (objtype, bucket)
+            for objtype in types
+            for bucket in range(
+                (lastid + 1) // self.FANOUT_BUCKET, head // self.FANOUT_BUCKET + 1
+            )
+        ]
+        changes = []
+        for value in self._cache.get_many(keys).values():
+            changes.extend(
+                tuple(entry) for entry in value["data"] if lastid < entry[0] <= head
+            )
+        return sorted(changes)
+
+    def changes_firstid(self):
+        # changes before this were dropped by compact()
+        first = self._cache.get_expiry("changes:first")
+        return int(first) if first else 0
+
+    def compact(self, retain=None):
+        # Drop changesets and fan-out buckets older than the last retain
+        # changes that no endpoint still needs, and records of objects
+        # that are gone, then let the backend reclaim the space.
+        if self._readonly:
+            raise IOError("cache opened in readonly mode")
+        if retain is None:
+            retain = self.CHANGES_RETAIN
+        head = self.changes_lastid()
+        keys = self._cache.keys()
+        paths = self._synced_paths(keys)
+        # endpoints nobody read for a while catch up first, so they don't
+        # hold on to old changes or have to resync afterwards
+        endpoints = self._catch_up(paths)
+        cutoff = min([head - retain] + [sd._csid for sd in endpoints])
+
+        drops = []
+        changes = buckets = 0
+        for key in keys:
+            if not key.startswith("changes:"):
+                continue
+            parts = key.split(":")
+            if len(parts) == 2 and parts[1].isdigit() and int(parts[1]) <= cutoff:
+                drops.append(key)
+                changes += 1
+            elif (
+                parts[1] == "type"
+                and (int(parts[-1]) + 1) * self.FANOUT_BUCKET - 1 <= cutoff
+            ):
+                drops.append(key)
+                buckets += 1
+
+        orphans = 0
+        byprefix = dict(zip(paths, endpoints))
+        for key in keys:
+            path, _, oid = key.rpartition(":")
+            sd = byprefix.get(path)
+            if sd is not None and oid.isdigit() and int(oid) not in sd._allids:
+                drops.append(key)
+                orphans += 1
+
+        first = max(cutoff + 1, self.changes_firstid())
+        writes = [("changes:first", first)]
+        if (self._cache.get_expiry("changes:fanout") or 0) < first:
+            writes.append(("changes:fanout", first))
+        with self._cache.batch() as cache:
+            cache.delete_many(drops)
+            cache.set_many(writes)
+        before, after = self._cache.compact()
+        logger.info(
+            "compacted %d changes, %d fan-out buckets and %d orphans, "
+            "%d -> %d bytes" % (changes, buckets, orphans, before, after)
+        )
+        self.metrics.inc("compactions")
+        self.metrics.inc("compaction_reclaimed_bytes", max(0, before - after))
+        return {
+            "first": first,
+            "changes_deleted": changes,
+            "buckets_deleted": buckets,
+            "orphans_deleted": orphans,
+            "bytes_before": before,
+            "bytes_after": after,
+            "reclaimed": before - after,
+        }
+
+    def _synced_paths(self, keys):
+        # the endpoints with a changestate among keys
+        return [
+            key[:-1]
+            for key in keys
+            if key.endswith(":") and not key.startswith("changes:")
+        ]
+
+    def _catch_up(self, paths):
+        endpoints = []
+        for path in paths:
+            sd = self.endpoint(path)._make()
+            sd._update()
+            endpoints.append(sd)
+        return endpoints
+
+    def _snapshot_key(self, key, since):
+        # whether export_snapshot() includes key, changes up to since
+        # are not needed by any endpoint
+        if key.startswith(("__", "updater:", "usage:")):
+            return False
+        if not key.startswith("changes:"):
+            return True
+        parts = key.split(":")
+        if parts[1].isdigit():
+            return int(parts[1]) > since
+        if parts[1] == "type":
+            return (int(parts[-1]) + 1) * self.FANOUT_BUCKET - 1 > since
+        return False
+
+    def export_snapshot(self, dest):
+        # Write the synced endpoints (records, ids and indexes) and the
+        # changes they haven't applied yet to dest as gzipped JSON lines,
+        # after a header with the csid they are current to. Taken from
+        # the updater or a published snapshot it is consistent.
+        if not self._readonly:
+            self.follow()
+        keys = self._cache.keys()
+        paths = self._synced_paths(keys)
+        if self._readonly:
+            states = [self._cache.get_expiry(path + ":") for path in paths]
+            csids = [state["csid"] for state in states if state is not None]
+        else:
+            csids = [sd._csid for sd in self._catch_up(paths)]
+        csid = self.changes_lastid()
+        since = min([csid] + csids)
+        header = {
+            "format": self.SNAPSHOT_FORMAT,
+            "version": self.SNAPSHOT_VERSION,
+            "csid": csid,
+            "since": since,
+            "created": time.time(),
+            "endpoints": paths,
+        }
+        tmp = "%s.tmp-%d" % (dest, os.getpid())
+        count = 0
+        with gzip.open(tmp, "wt", encoding="UTF-8") as f:
+            f.write(json.dumps(header) + "\n")
+            wanted = [key for key in keys if self._snapshot_key(key, since)]
+            for key, value in self._cache.dump(wanted):
+                f.write(json.dumps([key, value["data"]]) + "\n")
+                count += 1
+        os.replace(tmp, dest)
+        logger.info("exported %d keys at csid %d to %s" % (count, csid, dest))
+        return dict(header, keys=count)
+
+    def import_snapshot(self, src):
+        # Replace the cache with a snapshot from export_snapshot(), the
+        # changelog after its csid is fetched from NetBox as usual.
+        if self._readonly:
+            raise IOError("cache opened in readonly mode")
+        count = 0
+        with gzip.open(src, "rt", encoding="UTF-8") as f:
+            header = json.loads(f.readline() or "null")
+            if (
+                not isinstance(header, dict)
+                or header.get("format") != self.SNAPSHOT_FORMAT
+            ):
+                raise ValueError("%s is not a cache snapshot" % src)
+            if header["version"] > self.SNAPSHOT_VERSION:
+                raise ValueError(
+                    "snapshot %s has version %d, newer than supported %d"
+                    % (src, header["version"], self.SNAPSHOT_VERSION)
+                )
+            with self._cache.batch() as cache:
+                cache.clear()
+                chunk = []
+                for line in f:
+                    chunk.append(tuple(json.loads(line)))
+                    if len(chunk) >= 1000:
+                        cache.set_many(chunk)
+                        count += len(chunk)
+                        chunk = []
+                count += len(chunk)
+                cache.set_many(
+                    chunk
+                    + [
+                        ("changes:last", header["csid"]),
+                        ("changes:first", header["since"] + 1),
+                        ("changes:fanout", header["since"] + 1),
+                    ]
+                )
+        self._dicts = {}
+        logger.info(
+            "imported %d keys at csid %d from %s" % (count, header["csid"], src)
+        )
+        return dict(header, keys=count)
+
     def changes_clear(self):
         del self._cache["changes:last"]
 
@@ -1,13 +1,13 @@
+import os
 import time
-
-try:
-    import ujson as json
-except ImportError:
-    import json
-import dbm
-import dbm.gnu
+import collections
+import concurrent.futures
+import contextlib
 import threading
 import logging
+from . import backends
+from . import codec as codecs
+from .metrics import NullMetrics
 
 logger = logging.getLogger("jsondictcache")
 
@@ -16,100 +16,632 @@ class NotInCache(Exception):
     pass
 
 
+class RWLock(object):
+    # Any number of readers or a single writer. Waiting writers keep new
+    # readers out, so a steady stream of reads can't starve them.
+    def __init__(self):
+        super().__init__()
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            try:
+                while self.writer or self.readers:
+                    self.cond.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+
+class LRUCache(object):
+    def __init__(self, maxitems=0, maxbytes=0):
+        super().__init__()
+        self.maxitems = maxitems
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            self._items.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self._items and (
+                (self.maxitems and len(self._items) > self.maxitems)
+                or (self.maxbytes and self.size > self.maxbytes)
+            ):
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+
+    def pop(self, key):
+        with self.lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def drop_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self._items if k.startswith(prefix)]:
+                self.size -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self._items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
 class JsonDictCache(object):
+    # key prefixes rewritten in place by the updater process
+    VOLATILE = (
+        "changes:last",
+        "changes:first",
+        "changes:fanout",
+        "changes:type:",
+        "updater:",
+        "usage:",
+    )
+    BULK_FRACTION = 0.5
+    # keys waiting for a background refresh, more are served stale as is
+    REFRESH_PENDING_MAX = 10000
+
     def __init__(
-        self, path, refresh, lifetime, readonly=False, quick=False, quick_lifetime=60
+        self,
+        path,
+        refresh,
+        lifetime,
+        readonly=False,
+        quick=False,
+        quick_lifetime=60,
+        memcache=0,
+        memcache_bytes=0,
+        backend="dbm",
+        codec="json",
+        reopen_check=1.0,
+        refresh_many=None,
+        metrics=None,
+        stale_while_revalidate=0,
+        refresh_workers=2,
+        migrate_codec=False,
     ):
         super().__init__()
         self.path = path
+        self.backend = backends.get_backend(backend, path)
+        self.codec = codecs.get_codec(codec)
+        # re-encode a cache stored with another codec instead of using it
+        self.migrate_codec = migrate_codec
         self.refresh = refresh
+        # refresh_many(path, ids) returns {id: data} for the ids that exist
+        self.refresh_many = refresh_many
         self.lifetime = lifetime
-        self.lock = threading.Lock()
+        # Expired entries younger than expiry + stale_while_revalidate are
+        # returned as they are while refresh_workers threads refresh them;
+        # older ones are refreshed while the caller waits. Either way only
+        # one refresh per key runs at a time.
+        self.stale_while_revalidate = stale_while_revalidate
+        self.refresh_workers = refresh_workers
+        self._refresh_lock = threading.Lock()
+        self._refreshing = {}
+        self._refresh_pool = None
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        # reads share the database handle, decoding happens outside
+        self.lock = RWLock()
         self.readonly = readonly
         self.quick = bool(quick)
         self.db_open_since = time.time()
         self.semi_quick = quick == "semi"
         self.semi_quick_lifetime = quick_lifetime
+        # how often readonly quick handles look for a newly published file
+        self.reopen_check = reopen_check
+        self.db_checked = 0
+        self.db_inode = None
+        # decoded records, see memoizable() for what may be kept here
+        self.mem = None
+        if memcache or memcache_bytes:
+            self.mem = LRUCache(memcache, memcache_bytes)
 
-        # ensure db location is usable
-        if readonly:
-            with dbm.gnu.open(self.path, "ru") as testopen:
-                pass
-        else:
-            with dbm.gnu.open(self.path, "c") as testopen:
-                pass
+        # ensure db location is usable and in a format we can read
+        with self.backend.open(readonly=readonly) as testopen:
+            self._check_format(testopen)
 
         self.db = None
+        self._batch_db = None
+        self._batch_depth = 0
         self.ensure_open_db()
 
+    def _check_format(self, db):
+        header = codecs.decode_header(db.get(codecs.FORMAT_KEY))
+        if header is None:
+            keys = db.keys()
+            stored = codecs.get_codec("json") if keys else None
+            version = 1 if keys else codecs.FORMAT_VERSION
+        else:
+            stored = codecs.get_codec(header["codec"])
+            version = header["version"]
+        if version > codecs.FORMAT_VERSION:
+            raise IOError(
+                "cache %s has format version %d, newer than supported %d"
+                % (self.path, version, codecs.FORMAT_VERSION)
+            )
+
+        if self.readonly:
+            # read whatever the updater process wrote
+            if stored is not None:
+                self.codec = stored
+            return
+        if (
+            stored is not None
+            and stored.name != self.codec.name
+            and not self.migrate_codec
+        ):
+            # writers disagreeing on the codec would keep discarding each
+            # other's records as undecodable
+            logger.warning(
+                "%s is stored as %s, using that instead of %s"
+                % (self.path, stored.name, self.codec.name)
+            )
+            self.codec = stored
+        if stored is not None and (
+            stored.name != self.codec.name or version != codecs.FORMAT_VERSION
+        ):
+            self._migrate(db, stored, version)
+        db.set(codecs.FORMAT_KEY, codecs.encode_header(self.codec))
+        db.sync()
+
+    def _migrate(self, db, stored, version):
+        logger.info(
+            "migrating %s from %s (v%d) to %s (v%d)"
+            % (
+                self.path,
+                stored.name,
+                version,
+                self.codec.name,
+                codecs.FORMAT_VERSION,
+            )
+        )
+        for key in db.keys():
+            if key == codecs.FORMAT_KEY:
+                continue
+            try:
+                value = stored.decode(db.get(key))
+            except stored.errors:
+                db.delete(key)
+                continue
+            db.set(key, self.codec.encode(value), value.get("ts"))
+
     def ensure_open_db(self):
-        with self.lock:
+        # checked under the shared lock, only a (re)open excludes readers
+        with self.lock.read():
+            if not self._reopen_needed():
+                return
+        with self.lock.write():
+            if self._batch_db is not None:
+                return
             if self.db is not None:
-                # TODO: The really clever solution here would be to check if the inode has changed
-                # (ie. was replaced by updater process)
-                if self.semi_quick and time.time() > (
-                    self.db_open_since + self.semi_quick_lifetime
-                ):
-                    self.db.close()
-                else:
-                    return
-            if self.quick and not self.readonly:
-                self.db = dbm.gnu.open(self.path, "cs")
-            elif self.quick and self.readonly:
-                self.db = dbm.gnu.open(self.path, "ru")
+                self.db.close()
+                self.db = None
+            self.db_inode = self._inode()
+            if self.readonly:
+                self.db = self.backend.open(readonly=True)
+            else:
+                self.db = self.backend.open(sync=True)
             self.db_open_since = time.time()
 
-    def get_expiry(self, item, default=None, expiry=None, cacheonly=False):
+    def _reopen_needed(self):
+        if self._batch_db is not None or not self.quick:
+            return False
+        if self.db is None:
+            return True
+        return (self.readonly and self._replaced()) or (
+            self.semi_quick
+            and time.time() > (self.db_open_since + self.semi_quick_lifetime)
+        )
+
+    def _inode(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _replaced(self):
+        # publish() renames a new file over ours, our handle keeps the old
+        # one open so its inode can't be reused meanwhile
+        now = time.time()
+        if now - self.db_checked < self.reopen_check:
+            return False
+        self.db_checked = now
+        inode = self._inode()
+        if inode is not None and inode != self.db_inode:
+            logger.debug("%s was replaced, reopening" % self.path)
+            return True
+        return False
+
+    def publish(self, dest, backend=None):
+        # write a consistent copy next to dest and rename it into place,
+        # readers of dest never see a partially written file; backend
+        # picks another format for the copy, e.g. "mmap"
+        if os.path.abspath(dest) == os.path.abspath(self.path):
+            raise ValueError("can't publish a cache onto itself")
+        tmp = "%s.tmp-%d" % (dest, os.getpid())
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        target = self.backend
+        if backend is not None:
+            target = backends.get_backend(backend, dest)
+        with self.batch():
+            with self.lock.read():
+                target.snapshot(self._batch_db, tmp)
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, dest)
+        fd = os.open(os.path.dirname(os.path.abspath(dest)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        logger.debug("published %s to %s" % (self.path, dest))
+
+    def keys(self, prefix=""):
         self.ensure_open_db()
-        with self.lock:
-            if self.quick:
-                try:
-                    value = json.loads(self.db.get(item, b"{}").decode("UTF-8"))
-                except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                    del self.db[item]
-                    value = "{}"
-            else:
-                with dbm.gnu.open(self.path, "ru" if self.readonly else "c") as db:
+        with self.lock.read(), self._open() as db:
+            return [key for key in db.keys() if key.startswith(prefix)]
+
+    def dump(self, keys):
+        # (key, decoded value) for the keys that exist, all read under one
+        # shared lock so this process can't write in between
+        self.ensure_open_db()
+        with self.lock.read(), self._open() as db:
+            for i in range(0, len(keys), 1000):
+                chunk = keys[i : i + 1000]
+                raws = db.get_many(chunk)
+                for key in chunk:
+                    if key not in raws:
+                        continue
                     try:
-                        value = json.loads(db.get(item, b"{}").decode("UTF-8"))
-                    except (UnicodeDecodeError, json.decoder.JSONDecodeError):
-                        del db[item]
-                        value = "{}"
+                        yield key, self.codec.decode(raws[key])
+                    except self.codec.errors:
+                        pass
+
+    def clear(self):
+        # drop everything but the format header
+        self.delete_many(key for key in self.keys() if key != codecs.FORMAT_KEY)
+        if self.mem is not None:
+            self.mem.clear()
+
+    def compact(self):
+        # let the backend reclaim the space of deleted keys, returns the
+        # size on disk before and after
+        before = self.backend.size()
+        with self.batch():
+            with self.lock.write():
+                self.backend.compact(self._batch_db)
+        after = self.backend.size()
+        logger.debug("compacted %s from %d to %d bytes" % (self.path, before, after))
+        return before, after
+
+    def memoizable(self, item):
+        if self.mem is None:
+            return False
+        if self.readonly:
+            # changestates and VOLATILE keys are rewritten without a
+            # changeset, so these always have to come from the database
+            return not item.startswith(self.VOLATILE) and not item.endswith(":")
+        return True
+
+    def invalidate(self, item):
+        if self.mem is not None:
+            self.mem.pop(item)
+
+    def invalidate_prefix(self, prefix):
+        if self.mem is not None:
+            self.mem.drop_prefix(prefix)
+
+    def _decode(self, raw):
+        # follow a writer that migrated the cache to another codec since
+        # we opened it, rather than taking its records for corrupt
+        try:
+            return self.codec.decode(raw)
+        except self.codec.errors:
+            if not self._codec_changed():
+                raise
+        return self.codec.decode(raw)
+
+    def _codec_changed(self):
+        with self.lock.read(), self._open() as db:
+            header = codecs.decode_header(db.get(codecs.FORMAT_KEY))
+        if header is None or header["codec"] == self.codec.name:
+            return False
+        logger.warning("%s is now stored as %s" % (self.path, header["codec"]))
+        self.codec = codecs.get_codec(header["codec"])
+        return True
+
+    def get_expiry(self, item, default=None, expiry=None, cacheonly=False):
+        endpoint = item.partition(":")[0]
+        memo = self.memoizable(item)
+        value = self.mem.get(item) if memo else None
+        if value is None:
+            self.ensure_open_db()
+            with self.metrics.timer("read_seconds", endpoint=endpoint, op="get"):
+                with self.lock.read(), self._open() as db:
+                    raw = db.get(item)
+                try:
+                    value = self._decode(raw) if raw is not None else {}
+                except self.codec.errors:
+                    if not self.readonly:
+                        self.delete_many([item])
+                    value = {}
+            # misses are not kept, the updater may fill them in at any time
+            if memo and "data" in value:
+                self.mem.put(item, value, len(raw))
+        else:
+            self.metrics.inc("memory_hits", endpoint=endpoint)
 
         if expiry is None or self.readonly:
             # logger.debug(f'{repr(item)} unchecked')
+            if "data" in value:
+                self.metrics.inc("cache_hits", endpoint=endpoint)
+            else:
+                self.metrics.inc("cache_misses", endpoint=endpoint, reason="missing")
             return value.get("data", default)
 
         ts = value.get("ts", 0)
         if time.time() - expiry < ts:
             # logger.debug(f'{repr(item)} cached')
+            self.metrics.inc("cache_hits", endpoint=endpoint)
             return value["data"]
 
+        ceiling = expiry + self.stale_while_revalidate
+        if "data" in value and time.time() - ceiling < ts:
+            self.metrics.inc("stale_hits", endpoint=endpoint)
+            self._revalidate(item)
+            return value["data"]
+
+        self.metrics.inc(
+            "cache_misses",
+            endpoint=endpoint,
+            reason="expired" if "data" in value else "missing",
+        )
         if cacheonly:
+            self.metrics.inc("not_in_cache", endpoint=endpoint)
             raise NotInCache()
 
         logger.debug("%r refreshing" % item)
-        data = self.refresh(item)
-        self[item] = data
+        return self._refresh_item(item)
+
+    def _claim(self, keys, limit=None):
+        # register a future for each key nobody refreshes yet, returns
+        # the claimed ones and the futures of the others by key
+        claimed = {}
+        running = {}
+        with self._refresh_lock:
+            for key in keys:
+                if key in self._refreshing:
+                    running[key] = self._refreshing[key]
+                elif limit is None or len(self._refreshing) < limit:
+                    self._refreshing[key] = claimed[key] = concurrent.futures.Future()
+        return claimed, running
+
+    def _finish(self, claimed, results=None, error=None):
+        # every waiter gets its own key's value, None if it is gone
+        with self._refresh_lock:
+            for key in claimed:
+                self._refreshing.pop(key, None)
+        for key, future in claimed.items():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results.get(key))
+
+    def _refresh_item(self, item, future=None):
+        # future is given if the caller claimed item already
+        if future is None:
+            claimed, running = self._claim([item])
+            if not claimed:
+                # someone else is refreshing it already
+                return running[item].result()
+            future = claimed[item]
+        endpoint = item.partition(":")[0]
+        try:
+            with self.metrics.timer("refresh_seconds", endpoint=endpoint):
+                data = self.refresh(item)
+            self[item] = data
+        except Exception as e:
+            self._finish({item: future}, error=e)
+            raise
+        self._finish({item: future}, {item: data})
         return data
 
-    def get_batch(self, path, ids):
+    def _pool(self):
+        with self._refresh_lock:
+            if self._refresh_pool is None:
+                self._refresh_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.refresh_workers,
+                    thread_name_prefix="cachedpynetbox-refresh",
+                )
+            return self._refresh_pool
+
+    def _revalidate(self, item):
+        claimed, _ = self._claim([item], self.REFRESH_PENDING_MAX)
+        if claimed:
+            self._pool().submit(
+                self._background, self._refresh_item, item, claimed[item]
+            )
+
+    def _revalidate_many(self, path, ids):
+        keys = dict(("%s:%d" % (path, id_), id_) for id_ in ids)
+        claimed, _ = self._claim(list(keys), self.REFRESH_PENDING_MAX)
+        if claimed:
+            self._pool().submit(
+                self._background,
+                self._refresh_batch,
+                path,
+                [keys[key] for key in claimed],
+                claimed,
+            )
+
+    def _refresh_batch(self, path, ids, claimed):
+        try:
+            with self.metrics.timer("refresh_seconds", endpoint=path):
+                fetched = self.refresh_many(path, ids)
+            results = dict(
+                ("%s:%d" % (path, id_), data) for id_, data in fetched.items()
+            )
+            self.set_many(results.items())
+        except Exception as e:
+            self._finish(claimed, error=e)
+            raise
+        self._finish(claimed, results)
+
+    def _background(self, func, *args):
+        endpoint = args[0].partition(":")[0]
+        self.metrics.inc("background_refreshes", endpoint=endpoint)
+        try:
+            func(*args)
+        except Exception:
+            self.metrics.inc("refresh_errors", endpoint=endpoint)
+            logger.exception("background refresh of %s failed" % args[0])
+
+    def get_many(self, items, memoize=True):
+        # decoded records by key, missing and undecodable ones are left out
+        values = {}
+        todo = []
+        for item in items:
+            value = self.mem.get(item) if self.memoizable(item) else None
+            if value is None:
+                todo.append(item)
+            else:
+                values[item] = value
+        if values and self.metrics:
+            hits = collections.Counter(item.partition(":")[0] for item in values)
+            for endpoint, count in hits.items():
+                self.metrics.inc("memory_hits", count, endpoint=endpoint)
+        if not todo:
+            return values
+
+        self.ensure_open_db()
+        with self.lock.read(), self._open() as db:
+            raws = db.get_many(todo)
+        for item, raw in raws.items():
+            try:
+                value = self._decode(raw)
+            except self.codec.errors:
+                continue
+            values[item] = value
+            if memoize and self.memoizable(item) and "data" in value:
+                self.mem.put(item, value, len(raw))
+        return values
+
+    def get_batch(self, path, ids, memoize=True, total=None):
         missing = set()
+        stale = []
         items = []
-        MISSING_THRESHOLD = 50
+        hits = expired = 0
+        CHUNK_SIZE = 1000
 
-        for id_ in ids:
-            full_id = "%s:%d" % (path, id_)
-            try:
-                items.append(
-                    self.get_expiry(full_id, None, self.lifetime, cacheonly=True)
+        # a full refetch of the endpoint only pays off when most of it is
+        # gone, total is its size when ids are only part of it
+        ids = list(ids)
+        bulk_threshold = (len(ids) if total is None else total) * self.BULK_FRACTION
+        for i in range(0, len(ids), CHUNK_SIZE):
+            keys = ["%s:%d" % (path, id_) for id_ in ids[i : i + CHUNK_SIZE]]
+            with self.metrics.timer("read_seconds", endpoint=path, op="batch"):
+                values = self.get_many(keys, memoize)
+            now = time.time()
+            for id_, key in zip(ids[i : i + CHUNK_SIZE], keys):
+                value = values.get(key, {})
+                if self.readonly:
+                    items.append(value.get("data"))
+                    if "data" in value:
+                        hits += 1
+                elif now - self.lifetime < value.get("ts", 0):
+                    items.append(value["data"])
+                    hits += 1
+                elif "data" in value and now - (
+                    self.lifetime + self.stale_while_revalidate
+                ) < value.get("ts", 0):
+                    items.append(value["data"])
+                    stale.append(id_)
+                else:
+                    missing.add(id_)
+                    if "data" in value:
+                        expired += 1
+            if len(missing) > bulk_threshold:
+                break
+        if stale:
+            self.metrics.inc("stale_hits", len(stale), endpoint=path)
+            if self.refresh_many is not None:
+                self._revalidate_many(path, stale)
+            else:
+                for id_ in stale:
+                    self._revalidate("%s:%d" % (path, id_))
+        self.metrics.inc("cache_hits", hits, endpoint=path)
+        self.metrics.inc("cache_misses", expired, endpoint=path, reason="expired")
+        self.metrics.inc(
+            "cache_misses",
+            (len(ids) - len(items) if self.readonly else len(missing)) - expired,
+            endpoint=path,
+            reason="missing",
+        )
+        if len(missing) <= bulk_threshold:
+            if missing and self.refresh_many is not None:
+                logger.debug("%s: missing %d items, fetching by id", path, len(missing))
+                self.metrics.inc("fetches", endpoint=path, kind="ids")
+                self.metrics.inc("fetched_objects", len(missing), endpoint=path)
+                with self.metrics.timer("fetch_seconds", endpoint=path, kind="ids"):
+                    fetched = self.refresh_many(path, missing)
+                self.set_many(
+                    ("%s:%d" % (path, id_), data) for id_, data in fetched.items()
                 )
-            except NotInCache:
-                missing.add(id_)
-                if len(missing) >= MISSING_THRESHOLD:
-                    break
-        else:
-            if missing:
+                if len(fetched) != len(missing):
+                    logger.debug(
+                        "%s: %d missing items are gone",
+                        path,
+                        len(missing) - len(fetched),
+                    )
+                items.extend(fetched.values())
+            elif missing:
                 logger.debug(
                     "%s: missing %d items, fetching individually", path, len(missing)
                 )
@@ -118,33 +650,104 @@ class JsonDictCache(object):
                     items.append(self.get_expiry(full_id, None, self.lifetime))
             return items
 
-        logger.debug("%s: missing >= %d items, using bulk fetch", path, len(missing))
-        self.refresh(path)
+        logger.debug("%s: missing %d items, using bulk fetch", path, len(missing))
+        self.metrics.inc("fetches", endpoint=path, kind="bulk")
+        with self.metrics.timer("fetch_seconds", endpoint=path, kind="bulk"):
+            self.refresh(path)
         return [self["%s:%d" % (path, id_)] for id_ in ids]
 
     def __getitem__(self, item):
         return self.get_expiry(item, None, self.lifetime)
 
     def __setitem__(self, item, data):
+        self.set_many([(item, data)])
+
+    def set_many(self, items):
         if self.readonly:
             raise IOError("cache opened in readonly mode")
-        with self.lock:
-            if self.quick:
-                self.db[item] = json.dumps({"ts": time.time(), "data": data}).encode(
-                    "UTF-8"
-                )
-            else:
-                with dbm.gnu.open(self.path, "c") as db:
-                    db[item] = json.dumps({"ts": time.time(), "data": data}).encode(
-                        "UTF-8"
-                    )
+        now = time.time()
+        written = []
+        for item, data in items:
+            value = {"ts": now, "data": data}
+            written.append((item, value, self.codec.encode(value)))
+        if len(written) > 1 and self._batch_db is None:
+            # one sync for all of them instead of one per key
+            with self.batch():
+                self._set_encoded(written, now)
+        else:
+            self._set_encoded(written, now)
+        for item, value, raw in written:
+            if self.memoizable(item):
+                self.mem.put(item, value, len(raw))
+
+    def _set_encoded(self, written, now):
+        with self.lock.write(), self._open(write=True) as db:
+            for item, _, raw in written:
+                db.set(item, raw, now)
 
     def __delitem__(self, item):
         if self.readonly:
             raise IOError("cache opened in readonly mode")
-        with self.lock:
-            if self.quick:
-                del self.db[item]
-            else:
-                with dbm.gnu.open(self.path, "c") as db:
-                    del db[item]
+        self.invalidate(item)
+        with self.lock.write(), self._open(write=True) as db:
+            db.delete(item)
+
+    def delete_many(self, items):
+        if self.readonly:
+            raise IOError("cache opened in readonly mode")
+        items = list(items)
+        for item in items:
+            self.invalidate(item)
+        if len(items) > 1 and self._batch_db is None:
+            with self.batch():
+                self._delete(items)
+        else:
+            self._delete(items)
+
+    def _delete(self, items):
+        with self.lock.write(), self._open(write=True) as db:
+            for item in items:
+                try:
+                    db.delete(item)
+                except KeyError:
+                    pass
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Keep one writable handle for every read and write until the
+        # outermost batch ends, then sync once. In quick mode the
+        # synchronous handle is swapped for a fast one meanwhile.
+        if self.readonly:
+            raise IOError("cache opened in readonly mode")
+        with self.lock.write():
+            if self._batch_depth == 0:
+                if self.db is not None:
+                    self.db.close()
+                    self.db = None
+                self._batch_db = self.backend.open()
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock.write():
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._batch_db.sync()
+                    self._batch_db.close()
+                    self._batch_db = None
+                    if self.quick:
+                        self.db = self.backend.open(sync=True)
+                        self.db_open_since = time.time()
+
+    @contextlib.contextmanager
+    def _open(self, write=False):
+        # callers hold self.lock, for writing if write; without a shared
+        # handle readers open their own readonly one, so they don't
+        # contend for the writer's file lock
+        if self._batch_db is not None:
+            yield self._batch_db
+        elif self.quick:
+            yield self.db
+        else:
+            with self.backend.open(readonly=self.readonly or not write) as db:
+                yield db
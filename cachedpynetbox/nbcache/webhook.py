@@ -0,0 +1,138 @@
+import hashlib
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+logger = logging.getLogger("syncednetbox.webhook")
+
+# NetBox webhooks (Operations > Webhooks, with an event rule for the
+# object types to follow) POST the object as the REST API returns it:
+#
+#   {"event": "updated", "model": "device", "data": {"id": 1, "url": ...}}
+#
+# signed with the webhook's secret in X-Hook-Signature (HMAC-SHA512).
+DELETE_EVENTS = ("deleted", "object_deleted")
+
+
+def signature(secret, body):
+    return hmac.new(secret.encode("UTF-8"), body, hashlib.sha512).hexdigest()
+
+
+def endpoint_path(data):
+    # .../api/dcim/front-ports/12/ -> dcim.front_ports
+    parts = [p for p in urlsplit(data.get("url") or "").path.split("/") if p]
+    if "api" not in parts:
+        return None
+    parts = parts[parts.index("api") + 1 :]
+    if parts and parts[-1].isdigit():
+        parts.pop()
+    if len(parts) < 2:
+        return None
+    return ".".join(p.replace("-", "_") for p in parts)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt % args)
+
+    def _send(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        receiver = self.server.receiver
+        if receiver.secret is not None:
+            given = self.headers.get("X-Hook-Signature", "")
+            if not hmac.compare_digest(given, signature(receiver.secret, body)):
+                logger.warning(
+                    "webhook from %s with bad signature" % self.client_address[0]
+                )
+                return self._send(403)
+        try:
+            event = json.loads(body)
+        except ValueError:
+            return self._send(400)
+        try:
+            receiver.handle(event)
+        except Exception:
+            # the changelog brings the change anyway
+            logger.exception("applying webhook failed")
+            return self._send(500)
+        self._send(204)
+
+
+class WebhookReceiver(object):
+    # Applies NetBox webhook events to the cache as they arrive: writers
+    # update the records and indexes of synced endpoints, readonly
+    # instances drop their memoized copies. Events only speed things up,
+    # the changelog stays the source of truth and fills in anything
+    # missed. With poll_interval the changelog is also followed in the
+    # background, so reads don't have to.
+    def __init__(self, snb, host="127.0.0.1", port=0, secret=None, poll_interval=None):
+        super().__init__()
+        self.snb = snb
+        self.secret = secret
+        self.poll_interval = poll_interval
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.receiver = self
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self._threads = []
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.server.server_address
+
+    def handle(self, event):
+        data = event.get("data") or {}
+        path = endpoint_path(data)
+        if path is None or "id" not in data:
+            logger.debug("ignoring webhook %r" % event.get("model"))
+            return
+        delete = event.get("event") in DELETE_EVENTS
+        logger.debug("webhook %s %s:%s" % (event.get("event"), path, data["id"]))
+        with self.lock:
+            self.snb.metrics.inc("webhook_events", endpoint=path)
+            self.snb.write_through(path, [data], delete)
+
+    def _poll(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.snb.follow()
+            except Exception:
+                logger.exception("changelog poll failed")
+
+    def start(self):
+        if self._threads:
+            return self
+        self._threads = [
+            threading.Thread(target=self.server.serve_forever, daemon=True)
+        ]
+        if self.poll_interval and not self.snb._readonly:
+            self._threads.append(threading.Thread(target=self._poll, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info("listening for webhooks on %s" % self.url)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
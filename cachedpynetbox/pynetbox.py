@@ -1,9 +1,47 @@
 from .nbcache.nbcache import SyncedNetbox
 import threading
 import requests
-import time
 import logging
-from typing import Any
+
+# what updater() and the cachedpynetbox-updater daemon keep warm until
+# consumers have used something, see warm_targets()
+WARM_ENDPOINTS = [
+    "dcim.virtual_chassis",
+    "dcim.devices",
+    "dcim.device_types",
+    "dcim.interfaces",
+    "ipam.ip_addresses",
+    "ipam.prefixes",
+    "ipam.vlans",
+    "extras.object_types",
+]
+WARM_INDEXES = [
+    ("dcim.virtual_chassis", "name"),
+    ("dcim.devices", "virtual_chassis.id"),
+    ("dcim.devices", "name"),
+    ("dcim.devices", "serial"),
+    ("dcim.devices", "role.slug"),
+    ("dcim.devices", "device_type.slug"),
+    ("dcim.device_types", "name"),
+    ("dcim.device_types", "model"),
+    ("dcim.interfaces", "device.name"),
+    ("dcim.interfaces", "type.label"),
+    ("dcim.interfaces", "lag"),
+    ("ipam.ip_addresses", "assigned_object.id"),
+    # SyncedNetbox.RELATIONS
+    ("dcim.interfaces", "device.id"),
+    ("dcim.interfaces", "lag.id"),
+    ("ipam.ip_addresses", "assigned_object_type+assigned_object.id"),
+]
+
+
+def warm_targets(snb, cachefiles=()):
+    # the endpoints and indexes consumers of snb actually used, or the
+    # defaults above if none were recorded yet
+    endpoints, indexes = snb.warm_targets(cachefiles)
+    if not endpoints and not indexes:
+        return WARM_ENDPOINTS, WARM_INDEXES
+    return endpoints, indexes
 
 
 class pynetbox:
@@ -18,17 +56,35 @@ class pynetbox:
         quick=False,
         debug=False,
         dbpath=".netbox-v2",
+        memcache=0,
+        memcache_bytes=0,
+        backend="dbm",
+        codec="json",
+        metrics=False,
+        changes_expiry=None,
+        stale_while_revalidate=0,
+        track_usage=True,
     ):
         self._snb = SyncedNetbox(
-            base_uri.replace("api/", ""), token, dbpath, readonly, quick
+            base_uri.replace("api/", ""),
+            token,
+            dbpath,
+            readonly,
+            quick,
+            memcache=memcache,
+            memcache_bytes=memcache_bytes,
+            backend=backend,
+            codec=codec,
+            metrics=metrics,
+            changes_expiry=changes_expiry,
+            stale_while_revalidate=stale_while_revalidate,
+            track_usage=track_usage,
         )
         self._base_uri = base_uri
         self._token = token
         self._offline = offline
         self._trace = trace
         self._cachetime = cachetime
-        self._lagmembers = None
-        self._lagmembers_lifetime = 0
         self._lock = threading.Lock()
         
         if debug == False:
@@ -40,36 +96,76 @@ class pynetbox:
         if self._token != None:
             self._sess.headers.update(authorization="Token {}".format(self._token))
 
-    def post_api(self, url, **kwargs):
+    def _request(self, method, url, data):
         full_url = self._base_uri + url
-        r = self._sess.post(full_url, json=kwargs)
+        r = self._sess.request(method, full_url, json=data)
         if r.status_code >= 400:
             raise ValueError(
                 "Error from netbox %s, status code %u, text:\n%s\n"
                 % (url, r.status_code, r.text)
             )
+        return r.json() if r.content else None
+
+    def _write_through(self, url, records, delete=False):
+        # dcim/front-ports/12/ -> dcim.front_ports, anything but a plain
+        # list or object route (e.g. dcim/devices/1/render-config/) and
+        # responses without records are left to the changelog
+        parts = [p.replace("-", "_") for p in url.strip("/").split("/")]
+        if parts and parts[-1].isdigit():
+            parts.pop()
+        if "?" in url or len(parts) != (3 if parts[:1] == ["plugins"] else 2):
+            return
+        if isinstance(records, dict):
+            records = [records]
+        if not isinstance(records, list) or not all(
+            isinstance(record, dict) and "id" in record for record in records
+        ):
+            return
+        self._snb.write_through(".".join(parts), records, delete)
+
+    def post_api(self, url, **kwargs):
+        ret = self._request("POST", url, kwargs)
+        self._write_through(url, ret)
+        return ret
 
     def patch_api(self, url, **kwargs):
-        full_url = self._base_uri + url
-        r = self._sess.patch(full_url, json=kwargs)
-        if r.status_code >= 400:
-            raise ValueError(
-                "Error from netbox %s, status code %u, text:\n%s\n"
-                % (url, r.status_code, r.text)
-            )
+        ret = self._request("PATCH", url, kwargs)
+        self._write_through(url, ret)
+        return ret
+
+    def bulk_create(self, url, items, chunksize=500):
+        # one POST of a list per chunk to a list endpoint, e.g.
+        # bulk_create("dcim/interfaces/", [{...}, {...}])
+        ret = []
+        for i in range(0, len(items), chunksize):
+            created = self._request("POST", url, items[i : i + chunksize])
+            self._write_through(url, created)
+            ret.extend(created)
+        return ret
+
+    def bulk_update(self, url, items, chunksize=500):
+        # items need their "id"
+        ret = []
+        for i in range(0, len(items), chunksize):
+            updated = self._request("PATCH", url, items[i : i + chunksize])
+            self._write_through(url, updated)
+            ret.extend(updated)
+        return ret
+
+    def bulk_delete(self, url, ids, chunksize=500):
+        ids = list(ids)
+        for i in range(0, len(ids), chunksize):
+            chunk = [{"id": oid} for oid in ids[i : i + chunksize]]
+            self._request("DELETE", url, chunk)
+            self._write_through(url, chunk, delete=True)
 
     def int_by_device_name(self, name):
         vc = self._snb.dcim.virtual_chassis.getindex("name", name)
         if len(vc) != 0:
-            ret = []
-            vc_devices = self._snb.dcim.devices.getindex(
-                "virtual_chassis.id", vc[0]["id"]
+            vc_devices = self._snb.related("virtual_chassis.devices", vc[0]["id"])
+            return self._snb.related(
+                "device.interfaces", *[dev["id"] for dev in vc_devices]
             )
-            for dev in vc_devices:
-                ret = ret + self._snb.dcim.interfaces.getindex(
-                    "device.name", dev["name"]
-                )
-            return ret
         return self._snb.dcim.interfaces.getindex("device.name", name)
 
     def ip_by_int_id(self, iid):
@@ -113,35 +209,10 @@ class pynetbox:
         return dict([(i["name"], i) for i in self._snb.dcim.racks.all()])
 
     def lag_members_by_iface(self, iface):
-        if self._lagmembers_lifetime < time.time():
-            self._lagmembers = None
-        if self._lagmembers is None:
-            self._lagmembers = {}
-            for lag in self._snb.dcim.interfaces.getindex(
-                "type.label", "Link Aggregation Group (LAG)"
-            ):
-                self._lagmembers.setdefault(lag["id"], [])
-
-            for ifloop in self._snb.dcim.interfaces.getindex("lag", Any):
-                lag = ifloop.get("lag", None)
-                assert lag
-                self._lagmembers.setdefault(lag["id"], []).append(ifloop)
-            self._lagmembers_lifetime = time.time() + self._cachetime / 2.0
-        return self._lagmembers[iface["id"]]
+        lag = self._snb.dcim.interfaces[iface["id"]]
+        if lag is None or lag["type"]["label"] != "Link Aggregation Group (LAG)":
+            raise KeyError(iface["id"])
+        return self._snb.related("lag.members", iface["id"])
 
     def updater(self):
-        self.int_by_device_name("")
-        self.ip_by_int_id(0)
-        self.prefixes()
-        self.vlans()
-        self.devices()
-        self.device_types()
-        self.device_type_by_name("")
-        self.has_poe("")
-        self.dev_by_name("")
-        self.dev_by_serial("")
-        self.dev_by_role("")
-        self.dev_by_type("")
-        self._snb.dcim.interfaces.getindex("type.label", "Link Aggregation Group (LAG)")
-        self._snb.dcim.interfaces.getindex("lag", Any)
-        self._snb.extras.object_types.all()
+        self._snb.warm(*warm_targets(self._snb))
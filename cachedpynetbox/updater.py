@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from .aio import AsyncSyncedNetbox
+from .nbcache.nbcache import SyncedNetbox
+from .pynetbox import WARM_ENDPOINTS, WARM_INDEXES
+
+logger = logging.getLogger("cachedpynetbox.updater")
+
+
+class Updater(object):
+    def __init__(
+        self,
+        snb,
+        endpoints=(),
+        indexes=(),
+        use_profile=True,
+        interval=5.0,
+        publish=None,
+        publish_interval=60.0,
+        publish_backend=None,
+        status_file=None,
+        metrics_file=None,
+        compact_interval=0.0,
+        changes_retain=None,
+        concurrency=1,
+        webhook=None,
+        webhook_secret=None,
+        export=None,
+        export_interval=3600.0,
+    ):
+        super().__init__()
+        self.snb = snb
+        self.endpoints = list(endpoints)
+        self.indexes = list(indexes)
+        # warm what consumers used, see SyncedNetbox.usage_profile()
+        self.use_profile = use_profile
+        self.interval = interval
+        self.publish = publish
+        self.publish_interval = publish_interval
+        self.publish_backend = publish_backend
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.compact_interval = compact_interval
+        self.changes_retain = changes_retain
+        # endpoints sync concurrently through asyncio if > 1
+        self.asnb = AsyncSyncedNetbox(snb, concurrency) if concurrency > 1 else None
+        # (host, port) to receive NetBox webhooks on, polling continues
+        self.webhook = webhook
+        self.webhook_secret = webhook_secret
+        # snapshot for new nodes to bootstrap from, see --bootstrap
+        self.export = export
+        self.export_interval = export_interval
+        self._exported = (None, 0)
+        self.stop = threading.Event()
+        self._published = (None, 0)
+        self._last_csid = None
+        self._compacted = time.time()
+
+    def targets(self):
+        # what consumers used plus the endpoints and indexes asked for,
+        # the defaults if neither
+        endpoints, indexes = [], []
+        if self.use_profile:
+            endpoints, indexes = self.snb.warm_targets(
+                [self.publish] if self.publish else []
+            )
+        endpoints += [path for path in self.endpoints if path not in endpoints]
+        indexes += [index for index in self.indexes if index not in indexes]
+        if not endpoints and not indexes:
+            return WARM_ENDPOINTS, WARM_INDEXES
+        return endpoints, indexes
+
+    def cycle(self):
+        start = time.time()
+        endpoints, indexes = [], []
+        try:
+            endpoints, indexes = self.targets()
+            if self.asnb is not None:
+                asyncio.run(self.asnb.warm(endpoints, indexes))
+            else:
+                self.snb.follow()
+                self.snb.warm(endpoints, indexes)
+            status = self.snb.status()
+            # a failed changelog poll is logged and skipped by follow()
+            status = dict(status, ok=status["poll_error"] is None)
+            if not status["ok"]:
+                status["error"] = status["poll_error"]
+            status["warm"] = {"endpoints": len(endpoints), "indexes": len(indexes)}
+        except Exception as e:
+            logger.exception("update cycle failed")
+            # NetBox may be down, so no polling here
+            status = dict(self.snb.status(poll=False), ok=False, error=str(e))
+
+        # compaction rewrites the database, off unless asked for
+        if (
+            status["ok"]
+            and self.compact_interval
+            and time.time() - self._compacted >= self.compact_interval
+        ):
+            try:
+                report = self.snb.compact(self.changes_retain)
+                status["compacted"] = dict(report, time=time.time())
+            except Exception as e:
+                logger.exception("compaction failed")
+                status["compacted"] = {"error": str(e), "time": time.time()}
+            self._compacted = time.time()
+
+        status["cycle_seconds"] = time.time() - start
+        status["pid"] = os.getpid()
+        # stored before publishing too, so readers of the snapshot see it
+        self.snb._cache["updater:status"] = status
+
+        # publishing copies the whole cache, so only when something changed,
+        # newly warmed indexes included
+        version = (status["csid"], frozenset(endpoints), frozenset(indexes))
+        published, published_at = self._published
+        if (
+            self.publish
+            and version != published
+            and time.time() - published_at >= self.publish_interval
+        ):
+            try:
+                self.snb.publish(self.publish, self.publish_backend)
+                self._published = (version, time.time())
+                status["published"] = self._published[1]
+            except Exception as e:
+                logger.exception("publishing failed")
+                status["publish_error"] = str(e)
+
+        csid, exported_at = self._exported
+        if (
+            self.export
+            and status["ok"]
+            and status["csid"] != csid
+            and time.time() - exported_at >= self.export_interval
+        ):
+            try:
+                self.snb.export_snapshot(self.export)
+                self._exported = (status["csid"], time.time())
+                status["exported"] = self._exported[1]
+            except Exception as e:
+                logger.exception("snapshot export failed")
+                status["export_error"] = str(e)
+
+        self.snb._cache["updater:status"] = status
+        if self.status_file:
+            self._write(self.status_file, json.dumps(status, indent=2, sort_keys=True))
+        if self.metrics_file:
+            self._write(self.metrics_file, self.snb.metrics.prometheus())
+        log = logger.debug
+        if not status["ok"] or status["csid"] != self._last_csid:
+            log = logger.info
+        self._last_csid = status["csid"]
+        log(
+            "csid %s, lag %.1fs, cycle %.2fs%s"
+            % (
+                status["csid"],
+                status["lag_seconds"] or 0.0,
+                status["cycle_seconds"],
+                "" if status["ok"] else ", failed: %s" % status["error"],
+            )
+        )
+        return status
+
+    def _write(self, path, text):
+        # replaced atomically, e.g. for the node_exporter textfile collector
+        tmp = "%s.tmp-%d" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def run(self, once=False):
+        receiver = None
+        if self.webhook and not once:
+            receiver = self.snb.listen_webhooks(
+                self.webhook[0], self.webhook[1], self.webhook_secret
+            )
+        while not self.stop.is_set():
+            start = time.time()
+            self.cycle()
+            if once:
+                break
+            self.stop.wait(max(0.0, self.interval - (time.time() - start)))
+        if receiver is not None:
+            receiver.stop()
+        if self.asnb is not None:
+            self.asnb.close()
+        logger.info("updater stopped")
+
+    def shutdown(self, *args):
+        logger.info("shutting down after the current cycle")
+        self.stop.set()
+
+
+def _index(spec):
+    path, sep, field = spec.partition(":")
+    if not sep or not field:
+        raise argparse.ArgumentTypeError("expected endpoint:field, got %r" % spec)
+    return (path, field)
+
+
+def _listen(spec):
+    host, sep, port = spec.rpartition(":")
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected host:port, got %r" % spec)
+    return (host or "127.0.0.1", int(port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Keep a cachedpynetbox cache in sync with NetBox."
+    )
+    parser.add_argument(
+        "--url",
+        default=os.environ.get("NETBOX_URL"),
+        help="NetBox API url, e.g. https://netbox.example.com/api/ ($NETBOX_URL)",
+    )
+    parser.add_argument(
+        "--token", default=os.environ.get("NETBOX_TOKEN"), help="($NETBOX_TOKEN)"
+    )
+    parser.add_argument("--dbpath", default=".netbox-v2")
+    parser.add_argument("--backend", default="dbm", choices=["dbm", "sqlite"])
+    parser.add_argument("--codec", default="json", choices=["json", "msgpack"])
+    parser.add_argument(
+        "--migrate-codec",
+        action="store_true",
+        help="re-encode a cache stored with another codec as --codec, "
+        "otherwise the stored codec is kept",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=5.0, help="changelog poll interval (s)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="requests in flight while syncing, endpoints sync in parallel if > 1",
+    )
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        metavar="PATH",
+        help="endpoint to keep warm, e.g. dcim.devices (repeatable)",
+    )
+    parser.add_argument(
+        "--index",
+        action="append",
+        type=_index,
+        metavar="PATH:FIELD",
+        help="index to keep warm, e.g. dcim.devices:name (repeatable)",
+    )
+    parser.add_argument(
+        "--no-profile",
+        dest="profile",
+        action="store_false",
+        help="don't warm the endpoints and indexes consumers used, only "
+        "--endpoint/--index or the defaults",
+    )
+    parser.add_argument(
+        "--publish", metavar="PATH", help="publish snapshots for readers here"
+    )
+    parser.add_argument("--publish-interval", type=float, default=60.0)
+    parser.add_argument(
+        "--publish-backend",
+        choices=["dbm", "sqlite", "mmap"],
+        help="format of published snapshots (default: --backend), mmap "
+        "snapshots are shared by all reader processes",
+    )
+    parser.add_argument(
+        "--compact-interval",
+        type=float,
+        default=0.0,
+        help="drop old changes and deleted objects and compact the "
+        "database this often (s), 0 disables",
+    )
+    parser.add_argument(
+        "--changes-retain",
+        type=int,
+        default=SyncedNetbox.CHANGES_RETAIN,
+        help="changesets to keep when compacting",
+    )
+    parser.add_argument(
+        "--webhook",
+        type=_listen,
+        metavar="HOST:PORT",
+        help="receive NetBox webhooks here and apply them right away",
+    )
+    parser.add_argument(
+        "--webhook-secret",
+        default=os.environ.get("NETBOX_WEBHOOK_SECRET"),
+        help="the webhook's secret ($NETBOX_WEBHOOK_SECRET)",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        metavar="PATH",
+        help="import this snapshot into an empty cache before the first sync",
+    )
+    parser.add_argument(
+        "--export", metavar="PATH", help="export snapshots for new nodes here"
+    )
+    parser.add_argument("--export-interval", type=float, default=3600.0)
+    parser.add_argument("--status-file", metavar="PATH")
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="write metrics in Prometheus text format here every cycle",
+    )
+    parser.add_argument("--once", action="store_true", help="run a single cycle")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+    if not args.url:
+        parser.error("--url or $NETBOX_URL is required")
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+    )
+
+    snb = SyncedNetbox(
+        args.url.replace("api/", ""),
+        args.token,
+        args.dbpath,
+        backend=args.backend,
+        codec=args.codec,
+        migrate_codec=args.migrate_codec,
+        metrics=bool(args.metrics_file),
+        track_usage=False,
+    )
+    if args.bootstrap and snb._cache.get_expiry("changes:last") is None:
+        snb.import_snapshot(args.bootstrap)
+    updater = Updater(
+        snb,
+        endpoints=args.endpoint or (),
+        indexes=args.index or (),
+        use_profile=args.profile,
+        interval=args.interval,
+        publish=args.publish,
+        publish_interval=args.publish_interval,
+        publish_backend=args.publish_backend,
+        status_file=args.status_file,
+        metrics_file=args.metrics_file,
+        compact_interval=args.compact_interval,
+        changes_retain=args.changes_retain,
+        concurrency=args.concurrency,
+        webhook=args.webhook,
+        webhook_secret=args.webhook_secret,
+        export=args.export,
+        export_interval=args.export_interval,
+    )
+    signal.signal(signal.SIGTERM, updater.shutdown)
+    signal.signal(signal.SIGINT, updater.shutdown)
+    updater.run(once=args.once)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from cachedpynetbox.nbcache import idset
+
+
+@pytest.mark.parametrize("size", [0, 5, idset.PLAIN_MAX + 1, 5000])
+def test_encoded_ids_decode_to_the_same_set(size):
+    rand = random.Random(size)
+    ids = set(rand.sample(range(1, 100000), size))
+    encoded = idset.encode(ids)
+    assert isinstance(encoded, dict) == (size > idset.PLAIN_MAX)
+    assert list(idset.decode(encoded)) == sorted(ids)
+
+
+def test_delta_follows_a_plain_set():
+    rand = random.Random(1)
+    ids = set(range(1, 2000))
+    delta = idset.DeltaIdSet(idset.IdSet(ids), gen=1)
+    for _ in range(3000):
+        oid = rand.randrange(1, 2500)
+        if rand.random() < 0.5:
+            ids.add(oid)
+            delta.add(oid)
+        else:
+            ids.discard(oid)
+            delta.discard(oid)
+    assert list(delta) == sorted(ids)
+
+    # the stored form, the base plus the delta, gives the same set again
+    stored = delta.delta()
+    loaded = idset.DeltaIdSet(
+        idset.decode(idset.encode(set(range(1, 2000)))),
+        stored["base"],
+        stored["add"],
+        stored["del"],
+    )
+    assert list(loaded) == sorted(ids)
+    assert len(loaded) == len(ids)
+
+    delta.rebase(2)
+    assert delta.delta() == {"base": 2, "add": [], "del": []}
+    assert list(delta) == sorted(ids)
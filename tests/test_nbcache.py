@@ -0,0 +1,337 @@
+import fcntl
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from fakenetbox import Dataset, FakeNetbox  # noqa: E402
+from cachedpynetbox.nbcache import idset  # noqa: E402
+from cachedpynetbox.nbcache.nbcache import SyncedNetbox  # noqa: E402
+from cachedpynetbox.pynetbox import pynetbox  # noqa: E402
+
+
+@pytest.fixture
+def netbox():
+    with FakeNetbox(Dataset(devices=10, interfaces_per_device=4)) as server:
+        yield server
+
+
+@pytest.fixture
+def snb(netbox, tmp_path):
+    return SyncedNetbox(
+        netbox.url,
+        "token",
+        str(tmp_path / "cache"),
+        backend="sqlite",
+        metrics=True,
+        track_usage=False,
+    )
+
+
+def counter(snb, name, **labels):
+    return snb.metrics.counters.get(snb.metrics._key(name, labels), 0)
+
+
+def test_unrelated_change_keeps_index(netbox, snb):
+    interfaces = snb.dcim.interfaces
+    before = interfaces.getindex("device.name", "device-1")
+    assert counter(
+        snb, "index_rebuilds", endpoint="dcim.interfaces", field="device.name"
+    ) == 1
+
+    netbox.dataset.update("dcim/devices", 1, {"description": "changed"})
+    snb.follow()
+
+    assert interfaces.getindex("device.name", "device-1") == before
+    assert counter(
+        snb, "index_rebuilds", endpoint="dcim.interfaces", field="device.name"
+    ) == 1
+    idx = snb._cache.get_expiry("dcim.interfaces:by-device.name")
+    assert idx["cset"] == snb.changes_lastid()
+
+
+@pytest.mark.parametrize(
+    "path,objtype",
+    [
+        ("ipam.ip_addresses", "ipam.ipaddress"),
+        ("ipam.prefixes", "ipam.prefix"),
+        ("dcim.device_types", "dcim.devicetype"),
+        ("dcim.virtual_chassis", "dcim.virtualchassis"),
+        ("dcim.interfaces", "dcim.interface"),
+        ("virtualization.interfaces", "virtualization.vminterface"),
+        ("vpn.ike_policies", "vpn.ikepolicy"),
+        ("plugins.netbox_bgp.sessions", "netbox_bgp.session"),
+    ],
+)
+def test_object_type(snb, path, objtype):
+    assert snb.object_type(path) == objtype
+
+
+def test_ip_address_changes_reach_cache(netbox, snb):
+    ips = snb.ipam.ip_addresses
+    assert ips[1].get("description") != "changed"
+    iface = ips[1]["assigned_object_id"]
+    assert [ip["id"] for ip in ips.getindex("assigned_object.id", iface)] == [1]
+
+    netbox.dataset.update(
+        "ipam/ip-addresses",
+        1,
+        {"description": "changed", "assigned_object": {"id": iface + 1}},
+    )
+    snb.follow()
+
+    assert ips[1]["description"] == "changed"
+    assert 1 not in [ip["id"] for ip in ips.getindex("assigned_object.id", iface)]
+    assert 1 in [ip["id"] for ip in ips.getindex("assigned_object.id", iface + 1)]
+
+
+def test_metrics_scrape_does_not_poll(netbox, snb):
+    snb.dcim.devices.all()
+    snb.changes_expiry = 0.0
+    requests = netbox.requests
+    assert "cachedpynetbox_changelog_csid" in snb.metrics.prometheus()
+    assert netbox.requests == requests
+
+
+def test_relation_follows_reassigned_ip(netbox, snb):
+    ip = snb.ipam.ip_addresses[1]
+    iface = ip["assigned_object_id"]
+    assert 1 in [i["id"] for i in snb.related("interface.ip_addresses", iface)]
+
+    netbox.dataset.update("ipam/ip-addresses", 1, {"assigned_object": {"id": 0}})
+    snb.follow()
+
+    assert 1 not in [i["id"] for i in snb.related("interface.ip_addresses", iface)]
+
+
+@pytest.mark.parametrize("readonly", [False, True])
+@pytest.mark.parametrize(
+    "url,response",
+    [
+        ("dcim/devices/1/", None),
+        ("dcim/devices/1/", {"detail": "no id"}),
+        ("dcim/devices/1/render-config/", {"content": "hostname sw1"}),
+        ("dcim/devices/", ["not a record"]),
+    ],
+)
+def test_write_through_skips_non_records(netbox, tmp_path, readonly, url, response):
+    SyncedNetbox(
+        netbox.url, "token", str(tmp_path / "cache"), backend="sqlite"
+    ).dcim.devices.all()
+    nb = pynetbox(
+        netbox.url + "api/",
+        "token",
+        dbpath=str(tmp_path / "cache"),
+        backend="sqlite",
+        readonly=readonly,
+    )
+    nb._write_through(url, response)
+    devices = netbox.dataset.tables["dcim/devices"]
+    assert len(nb._snb.dcim.devices.all()) == len(devices)
+
+
+def test_write_through_races_sync(netbox, snb):
+    # webhook write-through on one thread while another follows the
+    # changelog, the index has to end up matching the records
+    interfaces = snb.dcim.interfaces
+    interfaces.ensure_index("description")
+    ids = sorted(netbox.dataset.tables["dcim/interfaces"])
+    errors = []
+
+    def webhooks():
+        try:
+            for n in range(50):
+                oid = ids[n % len(ids)]
+                record = dict(interfaces[oid], description="hook %d" % n)
+                snb.write_through("dcim.interfaces", [record])
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=webhooks)
+    thread.start()
+    while thread.is_alive():
+        netbox.dataset.mutate(3)
+        snb.changes_expiry = 0.0
+        interfaces.getindex("description", "x")
+    thread.join()
+    assert not errors
+
+    items = snb._cache.get_expiry("dcim.interfaces:by-description")["items"]
+    for record in interfaces.all():
+        key = "VAL:%s" % record["description"]
+        assert record["id"] in idset.decode(items[key])
+
+
+def change(cid):
+    return {
+        "id": cid,
+        "changed_object_type": "dcim.device",
+        "changed_object_id": 1,
+        "action": {"value": "update"},
+    }
+
+
+def test_changelog_holes_share_one_grace_period(snb):
+    snb.CHANGES_GAP_GRACE = 0.5
+    csets = [change(cid) for cid in (1, 3, 5, 7, 9, 11)]
+    assert snb._changes_cursor(snb._ingest_changes(0, (0, None), csets)) == 1
+    time.sleep(0.6)
+    # the changes after the held back cursor come again, all holes expired
+    cursor = snb._ingest_changes(0, (1, None), csets[1:])
+    assert snb._changes_cursor(cursor) == 11
+
+
+def test_unreachable_netbox_is_reported(netbox, snb, tmp_path):
+    from cachedpynetbox.updater import Updater
+
+    updater = Updater(
+        snb,
+        endpoints=["dcim.devices"],
+        use_profile=False,
+        publish=str(tmp_path / "missing" / "snapshot"),
+    )
+    netbox.dataset.mutate(1)
+    # a failing publish is logged, the cycle still reports
+    assert "publish_error" in updater.cycle()
+    last_poll = snb.status()["last_poll"]
+
+    netbox.stop()
+    # no kept alive connection to the stopped server either
+    snb._netbox.http_session.close()
+    snb.changes_expiry = 0.0
+    status = updater.cycle()
+    assert not status["ok"] and status["error"]
+    assert snb.status(poll=False)["poll_error"]
+    assert snb.status(poll=False)["last_poll"] == last_poll
+    assert snb._cache["updater:status"]["ok"] is False
+
+
+def test_concurrent_followers_keep_all_fanout_entries(snb):
+    barrier = threading.Barrier(2)
+
+    def follow(first):
+        for cid in range(first, 61, 2):
+            barrier.wait()
+            snb._ingest_changes(0, (cid - 1, None), [change(cid)])
+
+    threads = [threading.Thread(target=follow, args=(n,)) for n in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    changes = snb.changes_for(["dcim.device"], 0, head=60)
+    assert [entry[0] for entry in changes] == list(range(1, 61))
+
+
+def test_iterall_fetches_a_cold_chunk_by_id(snb):
+    interfaces = snb.dcim.interfaces
+    ids = sorted(record["id"] for record in interfaces.all())
+    snb._cache.delete_many(["dcim.interfaces:%d" % oid for oid in ids[:10]])
+
+    labels = {"endpoint": "dcim.interfaces"}
+    bulk = counter(snb, "fetches", kind="bulk", **labels)
+
+    assert len(list(interfaces.iterall(chunksize=10))) == len(ids)
+    assert counter(snb, "fetches", kind="bulk", **labels) == bulk
+    assert counter(snb, "fetches", kind="ids", **labels) == 1
+
+
+def test_compaction_keeps_changes_a_synced_endpoint_needs(netbox, snb, monkeypatch):
+    interfaces = snb.dcim.interfaces
+    interfaces.all()
+    csid = snb.endpoint("dcim.interfaces")._make()._csid
+    for _ in range(5):
+        netbox.dataset.mutate(3)
+        snb.follow()
+    head = snb.changes_lastid()
+    assert head > csid
+
+    # an endpoint that can't catch up holds on to what it hasn't applied
+    monkeypatch.setattr(
+        snb, "_catch_up", lambda paths: [snb.endpoint(p)._make() for p in paths]
+    )
+    report = snb.compact(retain=0)
+    assert report["first"] == csid + 1
+    keys = set(snb._cache.keys())
+    assert all("changes:%d" % cid in keys for cid in range(csid + 1, head + 1))
+    monkeypatch.undo()
+
+    snb.changes_expiry = 0.0
+    table = netbox.dataset.tables["dcim/interfaces"]
+    assert sorted(
+        (record["id"], record["description"]) for record in interfaces.all()
+    ) == sorted((oid, record["description"]) for oid, record in table.items())
+
+
+def test_exported_snapshot_serves_readonly_readers(netbox, snb, tmp_path):
+    devices = snb.dcim.devices.all()
+    snb.dcim.interfaces.ensure_index("device.name")
+    byname = snb.dcim.interfaces.getindex("device.name", "device-1")
+    snb.export_snapshot(str(tmp_path / "snapshot.gz"))
+
+    dbpath = str(tmp_path / "imported")
+    SyncedNetbox(
+        netbox.url, "token", dbpath, backend="sqlite", track_usage=False
+    ).import_snapshot(str(tmp_path / "snapshot.gz"))
+    reader = SyncedNetbox(
+        netbox.url,
+        "token",
+        dbpath,
+        backend="sqlite",
+        readonly=True,
+        track_usage=False,
+    )
+    requests = netbox.requests
+    assert reader.dcim.devices.all() == devices
+    assert reader.dcim.interfaces.getindex("device.name", "device-1") == byname
+    assert reader.status(poll=False)["csid"] == snb.changes_lastid()
+    assert netbox.requests == requests
+
+
+def test_late_webhook_does_not_undo_newer_record(snb):
+    interfaces = snb.dcim.interfaces
+    newer = dict(
+        interfaces[1], description="newer", last_updated="2026-01-01T10:00:00.500000Z"
+    )
+    snb.write_through("dcim.interfaces", [newer])
+    older = dict(newer, description="older", last_updated="2026-01-01T10:00:00Z")
+
+    snb.write_through("dcim.interfaces", [older])
+    assert interfaces[1]["description"] == "newer"
+    snb.write_through("dcim.interfaces", [older], delete=True)
+    assert 1 in [record["id"] for record in interfaces.all()]
+
+    snb.write_through("dcim.interfaces", [newer], delete=True)
+    assert 1 not in [record["id"] for record in interfaces.all()]
+
+
+def test_busy_cache_and_usage_file_do_not_hold_up_reads(netbox, tmp_path):
+    path = str(tmp_path / "cache")
+    snb = SyncedNetbox(netbox.url, "token", path, backend="sqlite")
+    snb.changes_expiry = 3600.0
+    snb.dcim.interfaces.getindex("device.name", "device-1")
+    snb.USAGE_FLUSH_INTERVAL = 0.0
+
+    # another process writing the cache and the usage file
+    writer = sqlite3.connect(path)
+    writer.execute("BEGIN IMMEDIATE")
+    usage = open(path + ".usage.json", "a+")
+    fcntl.flock(usage, fcntl.LOCK_EX)
+    start = time.time()
+    for _ in range(3):
+        snb.dcim.interfaces.getindex("device.name", "device-1")
+    assert time.time() - start < 1.0
+    with snb._usage_flushing:
+        pass
+    writer.rollback()
+    usage.close()
+
+    # kept until the file can be written
+    snb.save_usage()
+    profile = snb._read_usage_file(path)
+    assert profile["indexes"]["dcim.interfaces:device.name"][0] == 4
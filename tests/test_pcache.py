@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from cachedpynetbox.nbcache import backends
+from cachedpynetbox.nbcache import codec as codecs
+from cachedpynetbox.nbcache import pcache
+
+
+def open_cache(path, **kwargs):
+    return pcache.JsonDictCache(
+        str(path), refresh=None, lifetime=7200, backend="sqlite", **kwargs
+    )
+
+
+def test_older_readers_refuse_id_set_layout(tmp_path, monkeypatch):
+    open_cache(tmp_path / "cache")["x:1"] = {"id": 1}
+    monkeypatch.setattr(codecs, "FORMAT_VERSION", 2)
+    with pytest.raises(IOError):
+        open_cache(tmp_path / "cache", readonly=True)
+
+
+def test_version_2_cache_is_migrated(tmp_path):
+    path = str(tmp_path / "cache")
+    with backends.SqliteBackend(path).open() as db:
+        db.set(codecs.FORMAT_KEY, b'{"version": 2, "codec": "json"}')
+        db.set("x:by-name", codecs.get_codec("json").encode({"data": {"a": [1]}}))
+    cache = open_cache(path)
+    assert cache.get_expiry("x:by-name") == {"a": [1]}
+    with backends.SqliteBackend(path).open() as db:
+        header = codecs.decode_header(db.get(codecs.FORMAT_KEY))
+    assert header["version"] == codecs.FORMAT_VERSION == 3
+
+
+def test_mmap_values_are_views(tmp_path):
+    cache = open_cache(tmp_path / "cache")
+    cache.set_many([("x:%d" % i, {"id": i, "name": "n%d" % i}) for i in range(100)])
+    cache.publish(str(tmp_path / "snap"), "mmap")
+    handle = backends.MmapBackend(str(tmp_path / "snap")).open(readonly=True)
+    raw = handle.get("x:42")
+    assert isinstance(raw, memoryview)
+    assert handle.get("x:420") is None
+    assert len(handle.keys()) == 101
+    handle.close()
+    # still readable until the last view is gone
+    assert codecs.get_codec("json").decode(raw)["data"]["id"] == 42
+
+    reader = pcache.JsonDictCache(
+        str(tmp_path / "snap"),
+        refresh=None,
+        lifetime=7200,
+        readonly=True,
+        backend="mmap",
+    )
+    assert reader.get_expiry("x:7") == {"id": 7, "name": "n7"}
+
+
+def test_set_many_syncs_once_in_quick_mode(tmp_path, monkeypatch):
+    cache = open_cache(tmp_path / "cache", quick=True)
+    autocommit = []
+    set_ = backends.SqliteHandle.set
+
+    def spy(handle, key, value, ts=None):
+        autocommit.append(handle.autocommit)
+        set_(handle, key, value, ts)
+
+    monkeypatch.setattr(backends.SqliteHandle, "set", spy)
+    cache.set_many(("x:%d" % i, {"id": i}) for i in range(100))
+    # written through the batch handle, not committed per key
+    assert autocommit == [False] * 100
+    assert cache.get_expiry("x:99") == {"id": 99}
+
+
+def test_writers_agree_on_the_stored_codec(tmp_path):
+    pytest.importorskip("msgpack")
+    path = tmp_path / "cache"
+    first = open_cache(path, codec="json")
+    first["x:1"] = {"id": 1}
+    second = open_cache(path, codec="msgpack")
+    assert second.codec.name == "json"
+    assert second.get_expiry("x:1") == {"id": 1}
+
+    # switching codecs is explicit, running writers follow it
+    migrated = open_cache(path, codec="msgpack", migrate_codec=True)
+    migrated["x:2"] = {"id": 2}
+    assert first.get_expiry("x:2") == {"id": 2}
+    assert first.codec.name == "msgpack"
+    assert first.get_expiry("x:1") == {"id": 1}
+
+
+def test_single_read_waits_for_its_own_record_in_a_batch(tmp_path):
+    release = threading.Event()
+
+    def refresh_many(path, ids):
+        release.wait(5)
+        return dict((id_, {"id": id_, "name": "new"}) for id_ in ids)
+
+    cache = pcache.JsonDictCache(
+        str(tmp_path / "cache"),
+        refresh=None,
+        lifetime=0.1,
+        backend="sqlite",
+        refresh_many=refresh_many,
+        stale_while_revalidate=0.5,
+    )
+    cache.set_many(("x:%d" % i, {"id": i, "name": "old"}) for i in range(1, 4))
+    time.sleep(0.2)
+    # stale, so revalidated in the background, which hangs in refresh_many
+    assert [item["name"] for item in cache.get_batch("x", [1, 2, 3])] == ["old"] * 3
+
+    time.sleep(0.5)
+    result = []
+    reader = threading.Thread(
+        target=lambda: result.append(cache.get_expiry("x:2", None, 0.1))
+    )
+    reader.start()
+    # let it find the batch's refresh and wait for it
+    time.sleep(0.1)
+    release.set()
+    reader.join()
+    assert result == [{"id": 2, "name": "new"}]